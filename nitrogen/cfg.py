@@ -2,6 +2,7 @@ from pydantic import BaseModel, Field
 
 from nitrogen.flow_matching_transformer.nitrogen import NitroGen_Config
 from nitrogen.mm_tokenizers import NitrogenTokenizerConfig
+from nitrogen.image_processor import ImageProcessorConfig
 
 class ModalityConfig(BaseModel):
     frame_per_sample: int = 1 # number of context frames per sample
@@ -23,4 +24,5 @@ class CkptConfig(BaseModel):
 
     model_cfg: NitroGen_Config = Field(..., description="Model configuration. This is a placeholder and should be replaced with the actual model config class.")
     tokenizer_cfg: NitrogenTokenizerConfig = Field(..., description="Tokenizer configuration. This is a placeholder and should be replaced with the actual tokenizer config class.")
-    modality_cfg: ModalityConfig = Field(..., description="Modality configuration for the dataset mixture.")
\ No newline at end of file
+    modality_cfg: ModalityConfig = Field(..., description="Modality configuration for the dataset mixture.")
+    image_processor_cfg: ImageProcessorConfig | None = Field(default=None, description="Image preprocessing parameters. If None, they are read from the HF image processor of the vision encoder.")
\ No newline at end of file
@@ -0,0 +1,332 @@
+"""
+Control loops that execute the action chunks predicted by the policy in an env.
+
+The env only needs `step(action) -> (obs, reward, terminated, truncated, info)`,
+so these loops run against `GamepadEnv` on Windows and against mock envs
+elsewhere (see `scripts/play_mock.py`).
+"""
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from nitrogen.shared import BUTTON_ACTION_TOKENS
+
+BUTTON_PRESS_THRES = 0.5
+MENU_BUTTONS = ["GUIDE", "START", "BACK"]
+
+
+def zero_action() -> OrderedDict:
+    return OrderedDict(
+        [
+            ("WEST", 0),
+            ("SOUTH", 0),
+            ("BACK", 0),
+            ("DPAD_DOWN", 0),
+            ("DPAD_LEFT", 0),
+            ("DPAD_RIGHT", 0),
+            ("DPAD_UP", 0),
+            ("GUIDE", 0),
+            ("AXIS_LEFTX", np.array([0], dtype=np.long)),
+            ("AXIS_LEFTY", np.array([0], dtype=np.long)),
+            ("LEFT_SHOULDER", 0),
+            ("LEFT_TRIGGER", np.array([0], dtype=np.long)),
+            ("AXIS_RIGHTX", np.array([0], dtype=np.long)),
+            ("AXIS_RIGHTY", np.array([0], dtype=np.long)),
+            ("LEFT_THUMB", 0),
+            ("RIGHT_THUMB", 0),
+            ("RIGHT_SHOULDER", 0),
+            ("RIGHT_TRIGGER", np.array([0], dtype=np.long)),
+            ("START", 0),
+            ("EAST", 0),
+            ("NORTH", 0),
+        ]
+    )
+
+
+def pred_to_env_actions(pred: dict, token_set=BUTTON_ACTION_TOKENS, no_menu=True) -> list[OrderedDict]:
+    """Convert a predicted action chunk into a list of gamepad actions for the env."""
+    j_left, j_right, buttons = pred["j_left"], pred["j_right"], pred["buttons"]
+
+    n = len(buttons)
+    assert n == len(j_left) == len(j_right), "Mismatch in action lengths"
+
+    env_actions = []
+    for i in range(n):
+        move_action = zero_action()
+
+        xl, yl = j_left[i]
+        xr, yr = j_right[i]
+        move_action["AXIS_LEFTX"] = np.array([int(xl * 32767)], dtype=np.long)
+        move_action["AXIS_LEFTY"] = np.array([int(yl * 32767)], dtype=np.long)
+        move_action["AXIS_RIGHTX"] = np.array([int(xr * 32767)], dtype=np.long)
+        move_action["AXIS_RIGHTY"] = np.array([int(yr * 32767)], dtype=np.long)
+
+        button_vector = buttons[i]
+        assert len(button_vector) == len(token_set), "Button vector length does not match token set length"
+
+        for name, value in zip(token_set, button_vector):
+            if "TRIGGER" in name:
+                move_action[name] = np.array([value * 255], dtype=np.long)
+            else:
+                move_action[name] = 1 if value > BUTTON_PRESS_THRES else 0
+
+        if no_menu:
+            if move_action["START"]:
+                print("Model predicted start, disabling this action")
+            for name in MENU_BUTTONS:
+                move_action[name] = 0
+
+        env_actions.append(move_action)
+    return env_actions
+
+
+class TemporalEnsemble:
+    """
+    Blend the overlapping action chunks predicted for the same steps.
+
+    Chunks are added with the step their first action is meant for. The action
+    for a step is blended from every chunk covering it, each weighted by
+    `exp(-decay * k)` where `k` is the index of the step in the chunk, i.e. how
+    many steps old the chunk's frame is. A positive decay favours the most
+    recent chunks, a negative one the oldest, and 0 weights them equally.
+    Joysticks are averaged and a button is pressed when the chunks pressing it
+    hold at least half of the weight.
+
+    The weighted sums and the blended actions are updated when a chunk is
+    added, in preallocated numpy buffers with one row per step, so reading the
+    action for a step returns views of one row without computing anything.
+    Steps must be read in increasing order: the rows of the steps before the
+    last one read are dropped, and chunks are only accumulated for the upcoming
+    `action_horizon` steps.
+    """
+
+    def __init__(self, decay=0.0, button_threshold=BUTTON_PRESS_THRES):
+        self.decay = decay
+        self.button_threshold = button_threshold
+        # Allocated when the first chunk is added, once the horizon is known
+        self.sums = None
+
+    def reset(self):
+        self.sums = None
+
+    def _allocate(self, pred, step):
+        self.horizon, num_buttons = pred["buttons"].shape
+        # Weighted sums of the joysticks, then of the button votes, for step `t` in row
+        # `t - base`. The rows of the upcoming `horizon` steps stay in the buffer, and are
+        # moved back to the top once `base` is `horizon` steps behind
+        self.sums = np.zeros((2 * self.horizon, 4 + num_buttons), dtype=np.float32)
+        self.totals = np.zeros((2 * self.horizon, 1), dtype=np.float32)
+        self.weights = np.exp(-self.decay * np.arange(self.horizon)).astype(np.float32)[:, None]
+        # Blended actions of the same rows, and the views of each row returned by get
+        self.blended = np.zeros_like(self.sums)
+        self.actions = [
+            {
+                "j_left": self.blended[row:row + 1, 0:2],
+                "j_right": self.blended[row:row + 1, 2:4],
+                "buttons": self.blended[row:row + 1, 4:],
+            }
+            for row in range(2 * self.horizon)
+        ]
+        # Scratch buffers of the weighted chunk
+        self.chunk = np.empty((self.horizon, 4 + num_buttons), dtype=np.float32)
+        self.pressed = np.empty((self.horizon, num_buttons), dtype=bool)
+        # First step whose row is still in use
+        self.base = self.first_step = step
+
+    def _advance(self, step):
+        """Drop the rows of the steps before `step`."""
+        if step <= self.first_step:
+            return
+        self.first_step = step
+        shift = step - self.base
+        if shift >= self.horizon:
+            # Rows kept, those of the steps in [step, base + 2 * horizon)
+            kept = max(0, 2 * self.horizon - shift)
+            for buffer in [self.sums, self.totals, self.blended]:
+                buffer[:kept] = buffer[len(buffer) - kept:]
+                buffer[kept:] = 0
+            self.base = step
+
+    def add(self, pred: dict, step: int):
+        """Add a chunk whose first action is meant for `step`."""
+        if self.sums is None:
+            self._allocate(pred, step)
+        self._advance(step)
+        # Actions for steps that were already read are dropped
+        start = max(step, self.first_step) - step
+        end = min(step + self.horizon, self.first_step + self.horizon) - step
+        if start >= end:
+            return
+        chunk, weights, pressed = self.chunk[start:end], self.weights[start:end], self.pressed[start:end]
+        np.multiply(pred["j_left"][start:end], weights, out=chunk[:, 0:2])
+        np.multiply(pred["j_right"][start:end], weights, out=chunk[:, 2:4])
+        np.greater(pred["buttons"][start:end], self.button_threshold, out=pressed)
+        np.multiply(pressed, weights, out=chunk[:, 4:])
+
+        rows = slice(step + start - self.base, step + end - self.base)
+        sums, totals, blended = self.sums[rows], self.totals[rows], self.blended[rows]
+        sums += chunk
+        totals += weights
+        np.divide(sums[:, 0:4], totals, out=blended[:, 0:4])
+        np.greater_equal(sums[:, 4:], 0.5 * totals, out=blended[:, 4:])
+
+    def get(self, step: int) -> dict | None:
+        """
+        Blended action for `step`, as a chunk of length 1, or None if no chunk
+        covers it. The arrays are views of the ensemble's buffers, valid until
+        the next chunk is added.
+        """
+        if self.sums is None or step < self.first_step:
+            return None
+        self._advance(step)
+        row = step - self.base
+        if self.totals[row, 0] == 0:
+            return None
+        return self.actions[row]
+
+
+def _select_action(actions, index, to_actions, ensemble, step):
+    if ensemble is None:
+        return actions[index]
+    return to_actions(ensemble.get(step))[0]
+
+
+def _execute(env, action, repeat, pred, chunk_id, index, on_step, on_action):
+    for _ in range(repeat):
+        obs, reward, terminated, truncated, info = env.step(action=action)
+        if on_step is not None:
+            on_step(obs, pred, index)
+    if on_action is not None:
+        on_action(action, chunk_id, index)
+    return obs, terminated or truncated
+
+
+def run_sync(
+    env, predict, obs, to_actions, repeat=1, num_chunks=None, on_step=None, on_action=None,
+    query_interval=None, ensemble=None,
+) -> dict:
+    """
+    Predict a chunk on the latest frame, execute it, and repeat.
+
+    The env should pause the game between steps, otherwise the game keeps running
+    while the agent waits for each prediction.
+
+    Args:
+        env: Env to act in.
+        predict: Function from a frame to an action chunk, e.g. `ModelClient.predict`.
+        obs: First frame.
+        to_actions: Function from an action chunk to a list of env actions.
+        repeat: Number of env steps each action is repeated for.
+        num_chunks: Number of chunks to predict, or None to run until the env is done.
+        on_step: Called as `on_step(obs, pred, index)` after every env step, with the
+            chunk being executed and the index of the current action in it.
+        on_action: Called as `on_action(action, chunk_id, index)` once an action
+            has been executed.
+        query_interval: Number of actions executed before predicting again,
+            by default the whole chunk.
+        ensemble: `TemporalEnsemble` blending the overlapping chunks, or None to
+            execute the actions of the latest chunk as predicted.
+
+    Returns:
+        Stats of the run: actions executed, chunks predicted and time spent
+        waiting for predictions.
+    """
+    stats = {"num_actions": 0, "num_chunks": 0, "skipped_actions": 0, "wait_s": 0.0}
+    if ensemble is not None:
+        ensemble.reset()
+    done = False
+    while not done and (num_chunks is None or stats["num_chunks"] < num_chunks):
+        start_time = time.perf_counter()
+        pred = predict(obs)
+        stats["wait_s"] += time.perf_counter() - start_time
+        chunk_id = stats["num_chunks"]
+        stats["num_chunks"] += 1
+        if ensemble is not None:
+            ensemble.add(pred, stats["num_actions"])
+
+        actions = to_actions(pred)
+        if query_interval is not None:
+            actions = actions[:query_interval]
+        for index in range(len(actions)):
+            action = _select_action(actions, index, to_actions, ensemble, stats["num_actions"])
+            obs, done = _execute(env, action, repeat, pred, chunk_id, index, on_step, on_action)
+            stats["num_actions"] += 1
+            if done:
+                break
+    return stats
+
+
+def run_pipelined(
+    env, predict, obs, to_actions, request_offset, repeat=1, num_chunks=None, on_step=None, on_action=None,
+    ensemble=None,
+) -> dict:
+    """
+    Execute each chunk while the next one is being predicted.
+
+    After `request_offset` actions of the current chunk, the latest frame is sent to
+    `predict` on a worker thread, and the env keeps executing the current chunk.
+    The new chunk is swapped in as soon as it arrives. Its first action was meant
+    for the step right after the frame was captured, so the actions covering the
+    steps executed since then are skipped. If the current chunk runs out first,
+    the loop waits for the prediction. With an `ensemble`, the new chunk is
+    blended with the chunks still covering the upcoming steps instead.
+
+    The env should keep the game running between steps, e.g. `GamepadEnv` with
+    `async_mode=True`. `predict` is only ever called from the worker thread
+    after the first chunk, one call at a time, so a `ModelClient` can be used
+    as is as long as nothing else uses it during the run.
+
+    Args:
+        request_offset: Number of actions of a chunk executed before the frame for
+            the next prediction is captured. With 0 the next prediction is
+            requested as soon as a chunk is swapped in; with the chunk length
+            it is requested once the chunk is done, without overlap. Lower
+            offsets query more often.
+
+    Other arguments and the returned stats are the same as for `run_sync`, with
+    the number of actions that were skipped in new chunks.
+    """
+    stats = {"num_actions": 0, "num_chunks": 0, "skipped_actions": 0, "wait_s": 0.0}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start_time = time.perf_counter()
+        pred = predict(obs)
+        stats["wait_s"] += time.perf_counter() - start_time
+        stats["num_chunks"] += 1
+        chunk_id, actions, index = 0, to_actions(pred), 0
+        if ensemble is not None:
+            ensemble.reset()
+            ensemble.add(pred, 0)
+        # Prediction in flight, and the action count when its frame was captured
+        pending, requested_at = None, None
+
+        done = False
+        while not done:
+            if pending is None and (num_chunks is None or stats["num_chunks"] < num_chunks):
+                if index >= min(request_offset, len(actions)):
+                    pending, requested_at = executor.submit(predict, obs), stats["num_actions"]
+
+            if pending is not None and (pending.done() or index >= len(actions)):
+                start_time = time.perf_counter()
+                pred = pending.result()
+                stats["wait_s"] += time.perf_counter() - start_time
+                stats["num_chunks"] += 1
+                chunk_id, actions = chunk_id + 1, to_actions(pred)
+                if ensemble is not None:
+                    ensemble.add(pred, requested_at)
+                index = stats["num_actions"] - requested_at
+                stats["skipped_actions"] += min(index, len(actions))
+                pending = None
+                continue
+
+            if index >= len(actions):
+                break
+            action = _select_action(actions, index, to_actions, ensemble, stats["num_actions"])
+            obs, done = _execute(env, action, repeat, pred, chunk_id, index, on_step, on_action)
+            stats["num_actions"] += 1
+            index += 1
+
+        if pending is not None:
+            pending.cancel()
+    return stats
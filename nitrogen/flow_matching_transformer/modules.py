@@ -42,17 +42,118 @@ class AdaLayerNorm(nn.Module):
         self.linear = nn.Linear(embedding_dim, output_dim)
         self.norm = nn.LayerNorm(output_dim // 2, norm_eps, norm_elementwise_affine)
 
+    def modulation(self, temb: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Scale and shift for the timestep embedding `temb`."""
+        temb = self.linear(self.silu(temb))
+        scale, shift = temb.chunk(2, dim=1)
+        return scale, shift
+
     def forward(
         self,
         x: torch.Tensor,
         temb: Optional[torch.Tensor] = None,
+        modulation: Optional[tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> torch.Tensor:
-        temb = self.linear(self.silu(temb))
-        scale, shift = temb.chunk(2, dim=1)
+        scale, shift = modulation if modulation is not None else self.modulation(temb)
         x = self.norm(x) * (1 + scale[:, None]) + shift[:, None]
         return x
 
 
+def project_encoder_kv(attn: Attention, encoder_hidden_states: torch.Tensor):
+    """
+    Project the encoder context to per-head keys and values, shaped
+    (B, heads, S, head_dim) as `F.scaled_dot_product_attention` expects.
+    """
+    batch_size = encoder_hidden_states.shape[0]
+    key = attn.to_k(encoder_hidden_states)
+    value = attn.to_v(encoder_hidden_states)
+    head_dim = key.shape[-1] // attn.heads
+    key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    if attn.norm_k is not None:
+        key = attn.norm_k(key)
+    return key, value
+
+
+def cross_attention_with_kv(
+    attn: Attention,
+    hidden_states: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Same computation as diffusers' `AttnProcessor2_0` for cross-attention, but
+    with keys/values that were projected ahead of time by `project_encoder_kv`.
+    """
+    batch_size = hidden_states.shape[0]
+    query = attn.to_q(hidden_states)
+    head_dim = query.shape[-1] // attn.heads
+    query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+    if attn.norm_q is not None:
+        query = attn.norm_q(query)
+
+    hidden_states = F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+    )
+    hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+    hidden_states = hidden_states.to(query.dtype)
+
+    # linear proj
+    hidden_states = attn.to_out[0](hidden_states)
+    # dropout
+    hidden_states = attn.to_out[1](hidden_states)
+    return hidden_states / attn.rescale_output_factor
+
+
+class EncoderKVCache:
+    """
+    Cross-attention keys/values of every DiT block for one encoder context.
+
+    The context is constant across the denoising steps of a prediction, so the
+    K/V projections only need to run on the first step. The cache is bound to
+    the `encoder_hidden_states` tensor it was built from and is cleared as soon
+    as `DiT.forward` is called with a different tensor. In-place updates of the
+    context tensor are not detected.
+    """
+
+    def __init__(self):
+        self.context = None
+        self.kv = {}
+
+    def bind(self, encoder_hidden_states: torch.Tensor):
+        if self.context is not encoder_hidden_states:
+            self.context = encoder_hidden_states
+            self.kv.clear()
+
+    def get(self, block_idx: int, attn: Attention, encoder_hidden_states: torch.Tensor):
+        if block_idx not in self.kv:
+            self.kv[block_idx] = project_encoder_kv(attn, encoder_hidden_states)
+        return self.kv[block_idx]
+
+    def clear(self):
+        self.context = None
+        self.kv.clear()
+
+
+class TimestepConditioning:
+    """
+    Everything a DiT derives from one timestep: the scale/shift of the
+    AdaLayerNorm of every block and of the output layer.
+
+    These only depend on the timestep, so a sampler with a fixed schedule can
+    compute them once per step of the schedule (`DiT.timestep_conditioning`)
+    and pass them to `DiT.forward` instead of the timestep, which then skips
+    the timestep encoder and the modulation layers.
+    """
+
+    def __init__(self, block_modulations: list, output_modulation: tuple[torch.Tensor, torch.Tensor]):
+        # (scale, shift) per block, None for blocks without AdaLayerNorm
+        self.block_modulations = block_modulations
+        # (shift, scale) of the output layer
+        self.output_modulation = output_modulation
+
+
 class BasicTransformerBlock(nn.Module):
     def __init__(
         self,
@@ -140,23 +241,47 @@ class BasicTransformerBlock(nn.Module):
         encoder_hidden_states: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         temb: Optional[torch.LongTensor] = None,
+        encoder_kv: Optional[tuple[torch.Tensor, torch.Tensor]] = None,
+        ada_modulation: Optional[tuple[torch.Tensor, torch.Tensor]] = None,
+        key_padding_mask: Optional[torch.Tensor] = None,
+        position_offset: int = 0,
     ) -> torch.Tensor:
+        """
+        `key_padding_mask` is a boolean (B, S) mask of the keys to attend to, the
+        encoder tokens for cross-attention and the tokens themselves otherwise.
+        `position_offset` is the position of the first token, for sequences whose
+        leading padding was dropped.
+        """
 
         # 0. Self-Attention
         if self.norm_type == "ada_norm":
-            norm_hidden_states = self.norm1(hidden_states, temb)
+            norm_hidden_states = self.norm1(hidden_states, temb, modulation=ada_modulation)
         else:
             norm_hidden_states = self.norm1(hidden_states)
 
         if self.pos_embed is not None:
-            norm_hidden_states = self.pos_embed(norm_hidden_states)
-
-        attn_output = self.attn1(
-            norm_hidden_states,
-            encoder_hidden_states=encoder_hidden_states,
-            attention_mask=attention_mask,
-            # encoder_attention_mask=encoder_attention_mask,
-        )
+            if position_offset == 0:
+                norm_hidden_states = self.pos_embed(norm_hidden_states)
+            else:
+                seq_length = norm_hidden_states.shape[1]
+                norm_hidden_states = norm_hidden_states + self.pos_embed.pe[:, position_offset:position_offset + seq_length]
+
+        if key_padding_mask is not None:
+            if encoder_kv is None:
+                context = encoder_hidden_states if encoder_hidden_states is not None else norm_hidden_states
+                encoder_kv = project_encoder_kv(self.attn1, context)
+            attn_output = cross_attention_with_kv(
+                self.attn1, norm_hidden_states, *encoder_kv, attention_mask=key_padding_mask[:, None, None, :]
+            )
+        elif encoder_kv is not None:
+            attn_output = cross_attention_with_kv(self.attn1, norm_hidden_states, *encoder_kv)
+        else:
+            attn_output = self.attn1(
+                norm_hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                attention_mask=attention_mask,
+                # encoder_attention_mask=encoder_attention_mask,
+            )
         if self.final_dropout:
             attn_output = self.final_dropout(attn_output)
 
@@ -255,9 +380,21 @@ class DiT(ModelMixin):
         timestep: Optional[torch.LongTensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_all_hidden_states: bool = False,
+        encoder_kv_cache: Optional[EncoderKVCache] = None,
+        timestep_conditioning: Optional[TimestepConditioning] = None,
+        encoder_padding_mask: Optional[torch.Tensor] = None,
     ):
-        # Encode timesteps
-        temb = self.timestep_encoder(timestep)
+        # `encoder_attention_mask` is ignored, as in training: padding tokens of the
+        # context are attended to. `encoder_padding_mask`, a boolean (B, S) mask of
+        # the context tokens to attend to, is applied, e.g. after dropping padding.
+
+        # Encode timesteps, unless their modulations were precomputed
+        if timestep_conditioning is None:
+            timestep_conditioning = self.timestep_conditioning(timestep)
+
+        # Reuse the cross-attention K/V if the context is the one the cache was built for
+        if encoder_kv_cache is not None:
+            encoder_kv_cache.bind(encoder_hidden_states)
 
         # Process through transformer blocks - single pass through the blocks
         hidden_states = hidden_states.contiguous()
@@ -273,21 +410,26 @@ class DiT(ModelMixin):
                     attention_mask=None,
                     encoder_hidden_states=None,
                     encoder_attention_mask=None,
-                    temb=temb,
+                    ada_modulation=timestep_conditioning.block_modulations[idx],
                 )
             else:
+                if encoder_kv_cache is not None:
+                    encoder_kv = encoder_kv_cache.get(idx, block.attn1, encoder_hidden_states)
+                else:
+                    encoder_kv = None
                 hidden_states = block(
                     hidden_states,
                     attention_mask=None,
                     encoder_hidden_states=encoder_hidden_states,
                     encoder_attention_mask=None,
-                    temb=temb,
+                    encoder_kv=encoder_kv,
+                    ada_modulation=timestep_conditioning.block_modulations[idx],
+                    key_padding_mask=encoder_padding_mask,
                 )
             all_hidden_states.append(hidden_states)
 
         # Output processing
-        conditioning = temb
-        shift, scale = self.proj_out_1(F.silu(conditioning)).chunk(2, dim=1)
+        shift, scale = timestep_conditioning.output_modulation
         hidden_states = self.norm_out(hidden_states) * (1 + scale[:, None]) + shift[:, None]
         if return_all_hidden_states:
             return self.proj_out_2(hidden_states), all_hidden_states
@@ -295,6 +437,17 @@ class DiT(ModelMixin):
             return self.proj_out_2(hidden_states)
 
 
+    def timestep_conditioning(self, timestep: torch.LongTensor) -> TimestepConditioning:
+        """Block and output modulations for `timestep`, shaped (N,) like in `forward`."""
+        temb = self.timestep_encoder(timestep)
+        block_modulations = [
+            block.norm1.modulation(temb) if block.norm_type == "ada_norm" else None
+            for block in self.transformer_blocks
+        ]
+        output_modulation = self.proj_out_1(F.silu(temb)).chunk(2, dim=1)
+        return TimestepConditioning(block_modulations, output_modulation)
+
+
 class SelfAttentionTransformerConfig(BaseModel):
     num_attention_heads: int = Field(default=8)
     attention_head_dim: int = Field(default=64)
@@ -349,6 +502,8 @@ class SelfAttentionTransformer(ModelMixin):
         self,
         hidden_states: torch.Tensor,  # Shape: (B, T, D)
         return_all_hidden_states: bool = False,
+        key_padding_mask: Optional[torch.Tensor] = None,  # Shape: (B, T), True for the tokens to attend to
+        position_offset: int = 0,
     ):
 
         # Process through transformer blocks - single pass through the blocks
@@ -357,7 +512,7 @@ class SelfAttentionTransformer(ModelMixin):
 
         # Process through transformer blocks
         for idx, block in enumerate(self.transformer_blocks):
-            hidden_states = block(hidden_states)
+            hidden_states = block(hidden_states, key_padding_mask=key_padding_mask, position_offset=position_offset)
             all_hidden_states.append(hidden_states)
 
         if return_all_hidden_states:
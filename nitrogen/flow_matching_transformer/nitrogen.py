@@ -1,17 +1,18 @@
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from pydantic import BaseModel, Field
 from pathlib import Path
 
 import yaml
-import numpy as np
 import torch
 import torch.nn.functional as F
 from einops import rearrange
 from torch import nn
 from torch.distributions import Beta
-from transformers import SiglipVisionModel, AutoModel
+from transformers import SiglipVisionConfig, SiglipVisionModel, AutoConfig, AutoModel
 
-from .modules import DiT, DiTConfig, SelfAttentionTransformer, SelfAttentionTransformerConfig
+from .modules import DiT, DiTConfig, EncoderKVCache, SelfAttentionTransformer, SelfAttentionTransformerConfig
+from .solvers import ODESolver, SolverConfig, get_solver
 
 _PAD_TOKEN = 0
 _IMG_TOKEN = 1
@@ -21,6 +22,15 @@ _PROPRIO_TOKEN = 3
 _ACT_TOKEN = 4
 _GAME_ID_TOKEN = 6
 
+# Inputs that are stacked along the batch dimension for batched CFG
+_CFG_BATCH_KEYS = ["vl_token_ids", "sa_token_ids", "vl_attn_mask", "dropped_images", "embodiment_id"]
+# Precomputed embedding indices, stacked too when both branches have them
+_CFG_INDEX_KEYS = ["vl_embedding_index", "sa_embedding_index"]
+
+# Number of sampling schedules whose timestep conditioning is kept
+_MAX_TIMESTEP_TABLES = 16
+# Maximum number of preallocated sampling buffers, see `SamplingBuffers`
+_MAX_SAMPLING_BUFFERS = 64
 
 class NitroGen_Config(BaseModel):
     model_type: str = Field(default="nitrogen", frozen=True)
@@ -40,6 +50,7 @@ class NitroGen_Config(BaseModel):
     num_inference_timesteps: int = Field(default=None, description="Number of inference steps for noise diffusion.")
     max_num_embodiments: int = Field(default=1, description="Number of embodiments.")
     vision_encoder_name: str = Field(default="google/siglip-large-patch16-256", description="Vision encoder name.")
+    vision_encoder_cfg: dict | None = Field(default=None, description="Vision encoder architecture config. If set, the encoder is built from it without downloading pretrained weights.")
     vision_hidden_size: int = Field(default=768, description="Siglip hidden size.")
     add_view_embed: bool = Field(default=False, description="Whether to add view embedding.")
 
@@ -49,6 +60,8 @@ class NitroGen_Config(BaseModel):
     tune_multi_projector: bool = Field(default=True, description="Tune multi projector if True.")
     tune_vl_mixing: bool = Field(default=True, description="Tune vl mixing if True.")
 
+    inference_only: bool = Field(default=False, description="Build the model without the modules sampling does not use, see NitroGen.prune_for_inference. Set by scripts/export_for_inference.py.")
+
     @classmethod
     def from_yaml(cls, yaml_path: str | Path) -> "NitroGen_Config":
         """Load configuration from a YAML file."""
@@ -56,6 +69,17 @@ class NitroGen_Config(BaseModel):
             config_dict = yaml.safe_load(f)
         return cls.model_validate(config_dict)
 
+def get_vision_encoder_config(vision_encoder_name: str) -> dict:
+    """
+    Fetch the architecture config of a pretrained vision encoder, without its
+    weights. Used to fill `NitroGen_Config.vision_encoder_cfg` for checkpoints
+    that only store the encoder name.
+    """
+    if "siglip" in vision_encoder_name:
+        return SiglipVisionConfig.from_pretrained(vision_encoder_name).to_dict()
+    return AutoConfig.from_pretrained(vision_encoder_name).to_dict()
+
+
 def swish(x):
     return x * torch.sigmoid(x)
 
@@ -103,9 +127,18 @@ class CategorySpecificLinear(nn.Module):
         self.b = nn.Parameter(torch.zeros(num_categories, hidden_dim))
 
     def forward(self, x, cat_ids):
-        selected_W = self.W[cat_ids]
-        selected_b = self.b[cat_ids]
-        return torch.bmm(x, selected_W) + selected_b.unsqueeze(1)
+        # Gathering W[cat_ids] would copy a full weight matrix per batch item, so
+        # the rows of each category go through a plain matmul with its weights
+        if self.num_categories == 1:
+            return torch.matmul(x, self.W[0]) + self.b[0]
+        out = None
+        for category in torch.unique(cat_ids).tolist():
+            rows = cat_ids == category
+            category_out = torch.matmul(x[rows], self.W[category]) + self.b[category]
+            if out is None:
+                out = category_out.new_empty(x.shape[:-1] + category_out.shape[-1:])
+            out[rows] = category_out
+        return out
 
 
 class CategorySpecificMLP(nn.Module):
@@ -132,11 +165,18 @@ class MultiEmbodimentActionEncoder(nn.Module):
         self.W3 = CategorySpecificLinear(num_embodiments, hidden_size, hidden_size)  # (w -> w)
         self.pos_encoding = SinusoidalPositionalEncoding(hidden_size)
 
-    def forward(self, actions, timesteps, cat_ids):
+    def tau_embedding(self, timesteps):
+        """Sinusoidal encoding of `timesteps`, shape (B,), as (B, 1, w)."""
+        return self.pos_encoding(timesteps.unsqueeze(1))
+
+    def forward(self, actions, timesteps, cat_ids, tau_emb=None, buffers=None):
         """
         actions:   shape (B, T, action_dim)
         timesteps: shape (B,)  -- a single scalar per batch item
         cat_ids:   shape (B,)
+        tau_emb:   optional precomputed `tau_embedding`, shape (B, 1, w) or (1, 1, w),
+                   in which case `timesteps` is ignored
+        buffers:   optional `SamplingBuffers` to concatenate into
         returns:   shape (B, T, hidden_size)
         """
         B, T, _ = actions.shape
@@ -144,7 +184,9 @@ class MultiEmbodimentActionEncoder(nn.Module):
         # 1) Expand each batch's single scalar time 'tau' across all T steps
         #    so that shape => (B, T)
         #    e.g. if timesteps is (B,), replicate across T
-        if timesteps.dim() == 1 and timesteps.shape[0] == B:
+        if tau_emb is not None:
+            pass
+        elif timesteps.dim() == 1 and timesteps.shape[0] == B:
             # shape (B,) => (B,T)
             timesteps = timesteps.unsqueeze(1).expand(-1, T)
         else:
@@ -156,10 +198,17 @@ class MultiEmbodimentActionEncoder(nn.Module):
         a_emb = self.W1(actions, cat_ids)
 
         # 3) Get the sinusoidal encoding (B, T, w)
-        tau_emb = self.pos_encoding(timesteps).to(dtype=a_emb.dtype)
+        if tau_emb is not None:
+            tau_emb = tau_emb.to(dtype=a_emb.dtype).expand(B, T, -1)
+        else:
+            tau_emb = self.pos_encoding(timesteps).to(dtype=a_emb.dtype)
 
         # 4) Concat along last dim => (B, T, 2w), then W2 => (B, T, w), swish
-        x = torch.cat([a_emb, tau_emb], dim=-1)
+        if buffers is not None:
+            x = buffers.get("action_encoder_input", (B, T, 2 * self.hidden_size), a_emb.dtype, a_emb.device)
+            torch.cat([a_emb, tau_emb], dim=-1, out=x)
+        else:
+            x = torch.cat([a_emb, tau_emb], dim=-1)
         x = swish(self.W2(x, cat_ids))
 
         # 5) Finally W3 => (B, T, w)
@@ -167,6 +216,39 @@ class MultiEmbodimentActionEncoder(nn.Module):
         return x
 
 
+class SamplingBuffers:
+    """
+    Intermediate tensors of the sampling loop that are written in place, so
+    that every step after the first one reuses them instead of allocating:
+    the action encoder input and the state-action embeddings.
+
+    The buffers belong to the model, not to a session: a buffer is keyed by
+    its name, shape, dtype and device only, and every prediction of any
+    session with that key writes into the same tensor. The least recently
+    used buffers are dropped. Buffers are overwritten on the next step, their
+    contents must not be kept, and predictions sharing a model must not run
+    concurrently.
+    """
+
+    def __init__(self):
+        self.buffers = OrderedDict()
+
+    def get(self, name: str, shape: tuple, dtype: torch.dtype, device) -> torch.Tensor:
+        """Buffer `name` of the given shape, zero-filled when it is created."""
+        key = (name, tuple(shape), dtype, torch.device(device))
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+            return self.buffers[key]
+        buffer = torch.zeros(shape, dtype=dtype, device=device)
+        self.buffers[key] = buffer
+        if len(self.buffers) > _MAX_SAMPLING_BUFFERS:
+            self.buffers.popitem(last=False)
+        return buffer
+
+    def clear(self):
+        self.buffers.clear()
+
+
 class NitroGen(torch.nn.Module):
     config_class = NitroGen_Config
     supports_gradient_checkpointing = True
@@ -181,20 +263,41 @@ class NitroGen(torch.nn.Module):
         self.hidden_size = config.hidden_size
         self.vision_hidden_size = config.vision_hidden_size
 
+        # With an architecture config the encoder is built with random weights, which
+        # the checkpoint overwrites. Otherwise the pretrained weights are downloaded.
+        vision_encoder_cfg = config.vision_encoder_cfg
         if "siglip" in config.vision_encoder_name:
-            model = SiglipVisionModel.from_pretrained(config.vision_encoder_name)
+            if vision_encoder_cfg is not None:
+                model = SiglipVisionModel(SiglipVisionConfig.from_dict(vision_encoder_cfg))
+            else:
+                model = SiglipVisionModel.from_pretrained(config.vision_encoder_name)
             self.vision_encoder = model.vision_model
             self.vision_encoder_type = "siglip"
         else:
-            self.vision_encoder = AutoModel.from_pretrained(config.vision_encoder_name)
+            if vision_encoder_cfg is not None:
+                self.vision_encoder = AutoModel.from_config(AutoConfig.for_model(**vision_encoder_cfg))
+            else:
+                self.vision_encoder = AutoModel.from_pretrained(config.vision_encoder_name)
             self.vision_encoder_type = "hf_auto"
-        self.beta_dist = Beta(config.noise_beta_alpha, config.noise_beta_beta)
+        # Explicit CPU tensors so that the model can also be built on the meta device
+        self.beta_dist = Beta(
+            torch.tensor(config.noise_beta_alpha, device="cpu"),
+            torch.tensor(config.noise_beta_beta, device="cpu"),
+        )
         self.num_timestep_buckets = config.num_timestep_buckets
         # self.model = instantiate(config.diffusion_model_cfg)
         self.model = DiT(config=config.diffusion_model_cfg)
         self.action_dim = config.action_dim
         self.action_horizon = config.action_horizon
         self.num_inference_timesteps = config.num_inference_timesteps
+        # Timestep conditioning per sampling schedule, see `timestep_table`
+        self.timestep_tables = OrderedDict()
+        # Reused intermediate tensors of the sampling loops, see `SamplingBuffers`
+        self.sampling_buffers = SamplingBuffers()
+        # Quantization of the linear layers, set by inference_session.quantize_model
+        self.quantization = None
+        # Whether submodules are compiled, set by inference_session.compile_model
+        self.compiled = False
 
         # self.vl_self_attention_model = instantiate(config.vl_self_attention_cfg)
         self.vl_self_attention_model = SelfAttentionTransformer(config=config.vl_self_attention_cfg)
@@ -266,6 +369,8 @@ class NitroGen(torch.nn.Module):
             "total number of parameters: %e",
             sum(p.numel() for p in self.parameters() if p.requires_grad),
         )
+        if config.inference_only:
+            self.prune_for_inference()
 
     def set_trainable_parameters(
         self,
@@ -324,6 +429,24 @@ class NitroGen(torch.nn.Module):
         if not any(p.requires_grad for p in self.parameters()):
             print("Warning: No action head trainable parameters found.")
 
+    def prune_for_inference(self):
+        """
+        Remove what sampling never uses, in place: the pooling head of the SigLIP
+        encoder (only its last hidden state is read), the dropout layers, which
+        are identities in eval mode, the time distribution of training and the
+        gradient flags. The pruned model cannot be trained.
+        """
+        if self.vision_encoder_type == "siglip" and self.vision_encoder.use_head:
+            self.vision_encoder.use_head = False
+            del self.vision_encoder.head
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, nn.Dropout):
+                    setattr(module, name, nn.Identity())
+        self.beta_dist = None
+        self.requires_grad_(False)
+        return self.eval()
+
     def set_frozen_modules_to_eval_mode(self):
         """
         Huggingface will call model.train() at each training_step. To ensure
@@ -349,6 +472,12 @@ class NitroGen(torch.nn.Module):
             if not self.tune_vl_mixing:
                 self.vl_self_attention_model.eval()
 
+    def train(self, mode: bool = True):
+        # Training updates the weights the timestep tables are computed from
+        self.timestep_tables.clear()
+        self.sampling_buffers.clear()
+        return super().train(mode)
+
     # This function is supposedly incorrect
     # def sample_time(self, batch_size, device, dtype):
     #     sample = self.beta_dist.sample([batch_size]).to(device, dtype=dtype)
@@ -372,7 +501,50 @@ class NitroGen(torch.nn.Module):
             image_features = self.mm_projector(image_features)  # [B, 256, 1024] -> [B, 16, 1024]
         return image_features
 
+    def get_visual_features(self, data: dict):
+        """
+        Vision features for the frames in `data`. Callers that cache per-frame
+        features pass them as `visual_features` (B, F, N, D) instead of `images`.
+        """
+        if "visual_features" in data:
+            return data["visual_features"]
+        return self.encode_images(data["images"])
+
     def prepare_input_embs(self, vl_token_ids, sa_token_ids, vision, action, dropped_images, game_ids=None):
+        vl_embs = self.prepare_vl_embs(vl_token_ids, vision, dropped_images, game_ids=game_ids)
+        sa_embs = self.prepare_sa_embs(sa_token_ids, action)
+        return vl_embs, sa_embs
+
+    @staticmethod
+    def vl_embedding_index(vl_token_ids, dropped_images, tokens_per_image: int):
+        """
+        Index of the row of the embedding table of `prepare_vl_embs` that goes to
+        each VL position, shape (B, T). Per batch item, the table holds the vision
+        tokens of every frame, then the game embedding and a zero row for the
+        other tokens, e.g. padding.
+
+        It only depends on the token layout, so callers with a fixed layout, like
+        InferenceSession, compute it once and pass it as `embedding_index`. It is
+        built with static-shape ops, without host syncs.
+        """
+        num_rows = dropped_images.shape[1] * tokens_per_image
+        image_mask = vl_token_ids == _IMG_TOKEN
+        # Rank of each image token among the image tokens of its row
+        image_rank = (torch.cumsum(image_mask, dim=1) - 1).clamp(min=0)
+        # Frames that were not dropped, in order, followed by the dropped ones
+        frame_order = torch.argsort(dropped_images.to(torch.uint8), dim=1, stable=True)
+        frame = torch.gather(frame_order, 1, (image_rank // tokens_per_image).clamp(max=frame_order.shape[1] - 1))
+        index = torch.where(image_mask, frame * tokens_per_image + image_rank % tokens_per_image, num_rows + 1)
+        return torch.where(vl_token_ids == _GAME_ID_TOKEN, num_rows, index)
+
+    def prepare_vl_embs(self, vl_token_ids, vision, dropped_images, game_ids=None, embedding_index=None):
+        """
+        With a precomputed `vl_embedding_index`, the embeddings are gathered in
+        one indexed copy, without validating the layout or syncing with the host.
+        """
+        if embedding_index is not None:
+            return self._gather_vl_embs(embedding_index, vision, game_ids)
+
         B, T = vl_token_ids.shape
         vl_embs = torch.full(
             size=(B, T, self.vision_hidden_size), fill_value=0.0, dtype=vision.dtype, device=vision.device
@@ -432,10 +604,57 @@ class NitroGen(torch.nn.Module):
             repeated_sep = self.vis_sep_embedding.unsqueeze(0).expand(num_sep, self.hidden_size)
             # Assign the separator embeddings to the correct positions.
             vl_embs[sep_mask] = repeated_sep.to(dtype=vl_embs.dtype)
+        return vl_embs
+
+    def _gather_vl_embs(self, embedding_index, vision, game_ids=None):
+        B, num_images, tokens_per_image, hidden_size = vision.shape
+        vision_flat = vision.reshape(B, num_images * tokens_per_image, self.vision_hidden_size)
+        if self.game_mapping is not None and game_ids is not None:
+            game_embs = self.game_embedding(game_ids).to(dtype=vision.dtype)[:, None]
+        else:
+            game_embs = vision.new_zeros(B, 1, self.vision_hidden_size)
+        table = torch.cat([vision_flat, game_embs, vision.new_zeros(B, 1, self.vision_hidden_size)], dim=1)
+        return torch.gather(table, 1, embedding_index.unsqueeze(-1).expand(-1, -1, self.vision_hidden_size))
+
+    @staticmethod
+    def sa_embedding_index(sa_token_ids):
+        """
+        Index of the action token that goes to each state-action position, shape
+        (B, T), or T_action for positions left at zero. See `vl_embedding_index`.
+        """
+        action_mask = sa_token_ids == _ACT_TOKEN
+        num_actions = action_mask.shape[1]
+        action_rank = (torch.cumsum(action_mask, dim=1) - 1).clamp(min=0)
+        return torch.where(action_mask, action_rank, num_actions)
+
+    def prepare_sa_embs(self, sa_token_ids, action, embedding_index=None, buffers=None):
+        if embedding_index is not None:
+            # Actions and the zero row gathered in one indexed copy, see `sa_embedding_index`
+            B, T = embedding_index.shape
+            index = embedding_index.unsqueeze(-1).expand(-1, -1, self.hidden_size)
+            if buffers is not None:
+                # The zero row of the table is written once, when the buffer is created
+                num_actions = action.shape[1]
+                table = buffers.get("sa_table", (B, num_actions + 1, self.hidden_size), action.dtype, action.device)
+                table[:, :num_actions].copy_(action)
+                sa_embs = torch.gather(
+                    table, 1, index, out=buffers.get("sa_gather", (B, T, self.hidden_size), action.dtype, action.device)
+                )
+            else:
+                table = torch.cat([action, action.new_zeros(B, 1, self.hidden_size)], dim=1)
+                sa_embs = torch.gather(table, 1, index)
+            if self.config.add_pos_embed:
+                # Same rows as position_embedding(arange(T)), without the lookup
+                pos_embs = self.position_embedding.weight[:T]
+                if buffers is not None:
+                    dtype = torch.promote_types(sa_embs.dtype, pos_embs.dtype)
+                    return torch.add(sa_embs, pos_embs, out=buffers.get("sa_embs", (B, T, self.hidden_size), dtype, action.device))
+                sa_embs = sa_embs + pos_embs
+            return sa_embs
 
         B, T = sa_token_ids.shape
         sa_embs = torch.full(
-            size=(B, T, self.hidden_size), fill_value=0.0, dtype=vision.dtype, device=vision.device
+            size=(B, T, self.hidden_size), fill_value=0.0, dtype=action.dtype, device=action.device
         )
 
         # Project state.
@@ -454,7 +673,52 @@ class NitroGen(torch.nn.Module):
             pos_embs = self.position_embedding(pos_ids)  # (T, hidden_size)
             pos_embs = pos_embs.unsqueeze(0).expand(B, T, self.hidden_size)
             sa_embs = sa_embs + pos_embs
-        return vl_embs, sa_embs
+        return sa_embs
+
+    def prepare_vl_context(self, data: dict, visual_features, game_ids=None):
+        """
+        Build the vision-language context the DiT cross-attends to. It does not
+        depend on the noisy actions, so samplers call it once per prediction.
+        """
+        vl_embs = self.prepare_vl_embs(
+            data["vl_token_ids"],
+            visual_features,
+            data["dropped_images"],
+            game_ids=game_ids,
+            embedding_index=data.get("vl_embedding_index"),
+        )
+        return self.vl_self_attention_model(
+            vl_embs,
+            key_padding_mask=data.get("vl_padding_mask"),
+            position_offset=data.get("vl_position_offset", 0),
+        )
+
+    @staticmethod
+    def trim_vl_padding(data: dict) -> dict:
+        """
+        Copy of `data` without the leading VL columns that are padding in every
+        row, so that VL mixing and cross-attention only run on real tokens.
+
+        The tokenizer left-pads `vl_token_ids` to `max_sequence_length`, and the
+        model was trained attending to the padding tokens too, so predictions
+        differ slightly from the padded path. Positions keep their index in the
+        padded sequence (`vl_position_offset`). Rows with more padding than the
+        others keep some, which is masked out with `vl_padding_mask`, or None if
+        no padding is left.
+        """
+        vl_attn_mask = data["vl_attn_mask"].bool()
+        real_columns = vl_attn_mask.any(dim=0).nonzero()
+        start = int(real_columns[0]) if len(real_columns) > 0 else 0
+        trimmed = {
+            **data,
+            "vl_token_ids": data["vl_token_ids"][:, start:],
+            "vl_attn_mask": vl_attn_mask[:, start:],
+            "vl_position_offset": start,
+        }
+        if "vl_embedding_index" in data:
+            trimmed["vl_embedding_index"] = data["vl_embedding_index"][:, start:]
+        trimmed["vl_padding_mask"] = None if bool(trimmed["vl_attn_mask"].all()) else trimmed["vl_attn_mask"]
+        return trimmed
 
     def pack_actions(self, buttons, j_left, j_right):
         # Check that the first three dims of each input is the same
@@ -505,7 +769,7 @@ class NitroGen(torch.nn.Module):
         has_real_action = data["has_real_action"]
 
         # 1) Encode images/text/state
-        visual_features = self.encode_images(data["images"]) #, data["view_ids"])
+        visual_features = self.get_visual_features(data) #, data["view_ids"])
         # text_features = self.siglip_model.text_model(
         #     input_ids=data["lang_input_ids"]
         # ).last_hidden_state
@@ -564,21 +828,84 @@ class NitroGen(torch.nn.Module):
             "loss": loss,
         }
 
+    def _discrete_timesteps(self, solver: ODESolver, start_step: int) -> list[int]:
+        return [int(t * self.num_timestep_buckets) for t in solver.evaluation_times(start_step)]
+
+    @staticmethod
+    def noise_prior(prior_actions: torch.Tensor, noise: torch.Tensor, t0: float, solver: ODESolver):
+        """
+        Warm start: the sample at time t0 on the path from `noise` to `prior_actions`,
+        with t0 rounded down to the solver's time grid. Returns the sample and the
+        index of the first step left to integrate.
+        """
+        if not 0.0 <= t0 < 1.0:
+            raise ValueError(f"Warm start time must be in [0, 1), got {t0}")
+        start_step = solver.start_step(t0)
+        t_start = solver.times[start_step]
+        return (1 - t_start) * noise + t_start * prior_actions.to(noise.dtype), start_step
+
+    @torch.inference_mode()
+    def timestep_table(self, timesteps: list[int], device) -> dict[int, dict]:
+        """
+        Timestep conditioning of the action encoder (`tau_emb`) and of the DiT
+        (`dit`, a `TimestepConditioning`) for each discrete timestep of a
+        sampling schedule.
+
+        Tables are cached per (schedule, dtype, device, autocast dtype), so the
+        sampling loops only compute them on the first prediction with a given
+        schedule. Each timestep is computed on its own, exactly as the DiT
+        would for a batch of one timestep. The cache is cleared by `train()`;
+        call `timestep_tables.clear()` after changing the weights otherwise.
+        """
+        device = torch.device(device)
+        autocast_dtype = torch.get_autocast_dtype(device.type) if torch.is_autocast_enabled(device.type) else None
+        key = (tuple(timesteps), self.dtype, device, autocast_dtype)
+        if key in self.timestep_tables:
+            self.timestep_tables.move_to_end(key)
+            return self.timestep_tables[key]
+
+        table = {}
+        for t in timesteps:
+            if t not in table:
+                timestep = torch.tensor([t], dtype=torch.long, device=device)
+                table[t] = {
+                    "tau_emb": self.action_encoder.tau_embedding(timestep.float()),
+                    "dit": self.model.timestep_conditioning(timestep),
+                }
+        self.timestep_tables[key] = table
+        if len(self.timestep_tables) > _MAX_TIMESTEP_TABLES:
+            self.timestep_tables.popitem(last=False)
+        return table
+
     @torch.inference_mode()
-    def get_action(self, data: dict, old_layout:bool = False) -> dict:
+    def get_action(
+        self, data: dict, old_layout:bool = False, prior_actions=None, t0: float = 0.0, solver: SolverConfig | None = None,
+        drop_vl_padding: bool = False,
+    ) -> dict:
         """
         For i in [0..N-1]:
           1) t = i/N
           2) velocity = model(x(t), t)
           3) x(t + dt) = x(t) + dt * velocity
+
+        `solver` replaces this Euler loop with another method or time grid, see
+        `solvers.py`. By default it runs `num_inference_timesteps` Euler steps.
+
+        With `drop_vl_padding`, the VL padding tokens are dropped before VL mixing
+        and cross-attention, see `trim_vl_padding`.
+
+        With `prior_actions`, e.g. the previous action chunk shifted to the
+        current step, sampling starts from the prior noised to time t0 instead
+        of pure noise, and only the steps from t0 on are integrated.
         """
 
         # data = action_input
         embodiment_id = data["embodiment_id"]
 
-        batch_size = data["images"].shape[0]
-        device = data["images"].device
-        dtype = data["images"].dtype
+        batch_size = data["vl_token_ids"].shape[0]
+        device = data["vl_token_ids"].device
+        # Sample in fp32 at least, also with weights stored in a lower precision
+        dtype = torch.promote_types(data["images"].dtype if "images" in data else self.dtype, torch.float32)
         actions = torch.randn(
             size=(batch_size, self.config.action_horizon, self.config.action_dim),
             dtype=dtype,
@@ -586,61 +913,77 @@ class NitroGen(torch.nn.Module):
         )
 
         # 1) Hyperparameters for flow sampling
-        num_steps = self.num_inference_timesteps
-        dt = 1.0 / num_steps
+        ode_solver = get_solver(solver, self.num_inference_timesteps)
+        start_step = 0
+        if prior_actions is not None:
+            actions, start_step = self.noise_prior(prior_actions, actions, t0, ode_solver)
 
         # 2) Encode static context (images, text, state) once if it does not depend on actions
-        visual_features = self.encode_images(data["images"]) #, data["view_ids"])
+        if drop_vl_padding:
+            data = self.trim_vl_padding(data)
+        visual_features = self.get_visual_features(data) #, data["view_ids"])
         # text_features = self.siglip_model.text_model(
         #     input_ids=data["lang_input_ids"]
         # ).last_hidden_state
         # state_features = self.state_encoder(data["state"], embodiment_id)
+        vl_embs = self.prepare_vl_context(data, visual_features, game_ids=data["game_ids"])
+        # vl_embs = self.qformer(vl_embs)
+        # Cross-attention K/V of vl_embs are projected on the first step and reused afterwards
+        kv_cache = EncoderKVCache()
+        # Timestep embeddings and modulations of every step, computed once per schedule
+        timestep_table = self.timestep_table(self._discrete_timesteps(ode_solver, start_step), device)
 
-        # 3) Start denoising the actions
-        for i in range(num_steps):
+        def velocity(actions, t_cont):
             # ---- (a) Discretize continuous time in [0,1]
-            t_cont = i / float(num_steps)  # e.g. goes 0, 1/N, 2/N, ...
             t_discretized = int(t_cont * self.num_timestep_buckets)
+            conditioning = timestep_table[t_discretized]
 
             # ---- (b) Build embeddings (actions included)
             # Pass the *current* actions at time t into the action encoder
             action_features = self.action_encoder(
-                actions,
-                (torch.ones(actions.shape[0]) * t_discretized).to(device),
-                embodiment_id,
+                actions, None, embodiment_id, tau_emb=conditioning["tau_emb"], buffers=self.sampling_buffers
             )
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data["vl_token_ids"],
-                data["sa_token_ids"],
-                visual_features,
-                # text_features,
-                # state_features,
-                action_features,
-                data["dropped_images"],
-                game_ids=data["game_ids"],
+            sa_embs = self.prepare_sa_embs(
+                data["sa_token_ids"], action_features, data.get("sa_embedding_index"), buffers=self.sampling_buffers
             )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # vl_embs = self.qformer(vl_embs)
             # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
             model_output = self.model(
                 hidden_states=sa_embs,
                 encoder_hidden_states=vl_embs,
                 encoder_attention_mask=data["vl_attn_mask"],
-                timestep=timesteps,
+                encoder_kv_cache=kv_cache,
+                timestep_conditioning=conditioning["dit"],
+                encoder_padding_mask=data.get("vl_padding_mask"),
             )
             pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity = pred[:, -actions.shape[1] :]
+            return pred[:, -actions.shape[1] :]
 
-            # ---- (d) Naive Euler step: x(t + dt) = x(t) + dt * velocity
-            actions = actions + dt * pred_velocity
+        # 3) Denoise the actions, e.g. with Euler steps x(t + dt) = x(t) + dt * velocity
+        actions = ode_solver.integrate(velocity, actions, start_step)
 
         return {
             "action_tensor": actions,
         }
 
+    @staticmethod
+    def stack_cfg_branches(data_cond: dict, data_uncond: dict) -> dict:
+        """
+        Stack the conditional and unconditional inputs along the batch dimension,
+        conditional rows first. The branches may differ in `dropped_images` and
+        `vl_token_ids`, but must share the padded sequence length.
+        """
+        keys = _CFG_BATCH_KEYS + ["visual_features" if "visual_features" in data_cond else "images"]
+        keys += [key for key in _CFG_INDEX_KEYS if key in data_cond and key in data_uncond]
+        return {
+            key: torch.cat([data_cond[key], data_uncond[key]], dim=0)
+            for key in keys
+        }
+
     @torch.inference_mode()
-    def get_action_with_cfg(self, data_cond: dict, data_uncond: dict, cfg_scale: float = 1.0) -> dict:
+    def get_action_with_cfg(
+        self, data_cond: dict, data_uncond: dict, cfg_scale: float = 1.0, batched: bool | None = None, prior_actions=None, t0: float = 0.0,
+        solver: SolverConfig | None = None, drop_vl_padding: bool = False,
+    ) -> dict:
         """
         Use a form of classifier free guidance to sample actions. This can only be used on
         models that were trained on multiple frames of actions. The idea is that we sample
@@ -656,14 +999,26 @@ class NitroGen(torch.nn.Module):
           1) t = i/N
           2) velocity = (1 - cfg_scale) * model(x(t), t, None) + cfg_scale * model(x(t), t, history)
           3) x(t + dt) = x(t) + dt * velocity
+
+        If `batched` is True, both branches are stacked along the batch dimension and
+        go through the vision encoder, the VL mixing and the DiT in a single pass per
+        step. Otherwise they are run one after the other. By default they are batched
+        on CUDA only: on CPU, the doubled batch is not faster than two passes.
+
+        `prior_actions` and `t0` warm-start sampling, `solver` selects the
+        integration method and `drop_vl_padding` drops the VL padding, as in
+        `get_action`.
         """
 
         # data = action_input
         embodiment_id = data_cond["embodiment_id"]
 
-        batch_size = data_cond["images"].shape[0]
-        device = data_cond["images"].device
-        dtype = data_cond["images"].dtype
+        batch_size = data_cond["vl_token_ids"].shape[0]
+        device = data_cond["vl_token_ids"].device
+        if batched is None:
+            batched = device.type == "cuda"
+        # Sample in fp32 at least, also with weights stored in a lower precision
+        dtype = torch.promote_types(data_cond["images"].dtype if "images" in data_cond else self.dtype, torch.float32)
         actions = torch.randn(
             size=(batch_size, self.config.action_horizon, self.config.action_dim),
             dtype=dtype,
@@ -671,76 +1026,105 @@ class NitroGen(torch.nn.Module):
         )
 
         # 1) Hyperparameters for flow sampling
-        num_steps = self.num_inference_timesteps
-        dt = 1.0 / num_steps
+        ode_solver = get_solver(solver, self.num_inference_timesteps)
+        start_step = 0
+        if prior_actions is not None:
+            actions, start_step = self.noise_prior(prior_actions, actions, t0, ode_solver)
 
         # 2) Encode static context (images, text, state) once if it does not depend on actions
-        visual_features_cond = self.encode_images(data_cond["images"])
-        visual_features_uncond = self.encode_images(data_uncond["images"])
-        # text_features = self.siglip_model.text_model(
-        #     input_ids=data["lang_input_ids"]
-        # ).last_hidden_state
-        # state_features = self.state_encoder(data["state"], embodiment_id)
-
-        # 3) Start denoising the actions
-        for i in range(num_steps):
+        if batched:
+            data = self.stack_cfg_branches(data_cond, data_uncond)
+            if drop_vl_padding:
+                data = self.trim_vl_padding(data)
+            visual_features = self.get_visual_features(data)
+            vl_embs = self.prepare_vl_context(data, visual_features)
+            kv_cache = EncoderKVCache()
+        else:
+            if drop_vl_padding:
+                data_cond, data_uncond = self.trim_vl_padding(data_cond), self.trim_vl_padding(data_uncond)
+            visual_features_cond = self.get_visual_features(data_cond)
+            visual_features_uncond = self.get_visual_features(data_uncond)
+            # text_features = self.siglip_model.text_model(
+            #     input_ids=data["lang_input_ids"]
+            # ).last_hidden_state
+            # state_features = self.state_encoder(data["state"], embodiment_id)
+            vl_embs_cond = self.prepare_vl_context(data_cond, visual_features_cond)
+            vl_embs_uncond = self.prepare_vl_context(data_uncond, visual_features_uncond)
+            kv_cache_cond = EncoderKVCache()
+            kv_cache_uncond = EncoderKVCache()
+
+        # Timestep embeddings and modulations of every step, computed once per schedule
+        timestep_table = self.timestep_table(self._discrete_timesteps(ode_solver, start_step), device)
+
+        def velocity(actions, t_cont):
             # ---- (a) Discretize continuous time in [0,1]
-            t_cont = i / float(num_steps)  # e.g. goes 0, 1/N, 2/N, ...
             t_discretized = int(t_cont * self.num_timestep_buckets)
+            conditioning = timestep_table[t_discretized]
 
             # ---- (b) Build embeddings (actions included)
             # Pass the *current* actions at time t into the action encoder
             action_features = self.action_encoder(
-                actions,
-                (torch.ones(actions.shape[0]) * t_discretized).to(device),
-                embodiment_id,
+                actions, None, embodiment_id, tau_emb=conditioning["tau_emb"], buffers=self.sampling_buffers
             )
 
-            # Predict velocity with history
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data_cond["vl_token_ids"],
-                data_cond["sa_token_ids"],
-                visual_features_cond,
-                action_features,
-                data_cond["dropped_images"],
-            )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
-            model_output = self.model(
-                hidden_states=sa_embs,
-                encoder_hidden_states=vl_embs,
-                encoder_attention_mask=data_cond["vl_attn_mask"],
-                timestep=timesteps,
-            )
-            pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity_cond = pred[:, -actions.shape[1] :]
-
-            # Predict velocity without history
-            vl_embs, sa_embs = self.prepare_input_embs(
-                data_uncond["vl_token_ids"],
-                data_uncond["sa_token_ids"],
-                visual_features_uncond,
-                action_features,
-                data_uncond["dropped_images"],
-            )
-            vl_embs = self.vl_self_attention_model(vl_embs)
-            # ---- (c) Forward pass to get velocity = d/dt x(t)
-            timesteps = torch.from_numpy(np.array([t_discretized])).to(device).long()
-            model_output = self.model(
-                hidden_states=sa_embs,
-                encoder_hidden_states=vl_embs,
-                encoder_attention_mask=data_uncond["vl_attn_mask"],
-                timestep=timesteps,
-            )
-            pred = self.action_decoder(model_output, embodiment_id)
-            pred_velocity_uncond = pred[:, -actions.shape[1] :]
+            if batched:
+                # Predict velocity with and without history in one pass
+                sa_embs = self.prepare_sa_embs(
+                    data["sa_token_ids"], action_features.repeat(2, 1, 1), data.get("sa_embedding_index"),
+                    buffers=self.sampling_buffers,
+                )
+                # ---- (c) Forward pass to get velocity = d/dt x(t)
+                model_output = self.model(
+                    hidden_states=sa_embs,
+                    encoder_hidden_states=vl_embs,
+                    encoder_attention_mask=data["vl_attn_mask"],
+                    encoder_kv_cache=kv_cache,
+                    timestep_conditioning=conditioning["dit"],
+                    encoder_padding_mask=data.get("vl_padding_mask"),
+                )
+                pred = self.action_decoder(model_output, data["embodiment_id"])
+                pred_velocity_cond, pred_velocity_uncond = pred[:, -actions.shape[1] :].chunk(2, dim=0)
+            else:
+                # Predict velocity with history
+                sa_embs = self.prepare_sa_embs(
+                    data_cond["sa_token_ids"], action_features, data_cond.get("sa_embedding_index"),
+                    buffers=self.sampling_buffers,
+                )
+                # ---- (c) Forward pass to get velocity = d/dt x(t)
+                model_output = self.model(
+                    hidden_states=sa_embs,
+                    encoder_hidden_states=vl_embs_cond,
+                    encoder_attention_mask=data_cond["vl_attn_mask"],
+                    encoder_kv_cache=kv_cache_cond,
+                    timestep_conditioning=conditioning["dit"],
+                    encoder_padding_mask=data_cond.get("vl_padding_mask"),
+                )
+                pred = self.action_decoder(model_output, embodiment_id)
+                pred_velocity_cond = pred[:, -actions.shape[1] :]
+
+                # Predict velocity without history
+                sa_embs = self.prepare_sa_embs(
+                    data_uncond["sa_token_ids"], action_features, data_uncond.get("sa_embedding_index"),
+                    buffers=self.sampling_buffers,
+                )
+                # ---- (c) Forward pass to get velocity = d/dt x(t)
+                model_output = self.model(
+                    hidden_states=sa_embs,
+                    encoder_hidden_states=vl_embs_uncond,
+                    encoder_attention_mask=data_uncond["vl_attn_mask"],
+                    encoder_kv_cache=kv_cache_uncond,
+                    timestep_conditioning=conditioning["dit"],
+                    encoder_padding_mask=data_uncond.get("vl_padding_mask"),
+                )
+                pred = self.action_decoder(model_output, embodiment_id)
+                pred_velocity_uncond = pred[:, -actions.shape[1] :]
 
-            # ---- (d) Combine velocities with cfg_scale
-            pred_velocity = pred_velocity_cond + cfg_scale * (pred_velocity_cond - pred_velocity_uncond)
+            # ---- (d) Combine velocities with cfg_scale: cond + cfg_scale * (cond - uncond),
+            # in place in the unconditional velocity, a view of this step's DiT output
+            return pred_velocity_uncond.neg_().add_(pred_velocity_cond).mul_(cfg_scale).add_(pred_velocity_cond)
 
-            # ---- (e) Naive Euler step: x(t + dt) = x(t) + dt * velocity
-            actions = actions + dt * pred_velocity
+        # 3) Denoise the actions, e.g. with Euler steps x(t + dt) = x(t) + dt * velocity
+        actions = ode_solver.integrate(velocity, actions, start_step)
 
         return {
             "action_tensor": actions,
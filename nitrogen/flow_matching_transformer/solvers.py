@@ -0,0 +1,116 @@
+"""
+ODE solvers for the flow-matching sampler.
+
+The action head samples by integrating dx/dt = velocity(x, t) from noise at
+t=0 towards actions at t=1, where each velocity evaluation is a DiT call. A
+solver walks a time grid t_0=0 < t_1 < ... < t_N=1 and defines one step:
+
+- euler: x + dt * v(x, t), updated in place. One DiT call per step.
+- heun: second order, averages the velocity at both ends of the step. Two
+  DiT calls per step, except the last one which is an Euler step so that the
+  velocity is never evaluated at t=1, outside the training range of t.
+- midpoint: second order, uses the velocity at the middle of the step. Two
+  DiT calls per step.
+
+The grid is t_i = (i / N) ** time_power: uniform by default, denser near the
+noise with a power above 1 and near the actions below 1.
+"""
+from typing import Literal, Callable
+
+import torch
+from pydantic import BaseModel, Field
+
+
+class SolverConfig(BaseModel):
+    method: Literal["euler", "heun", "midpoint"] = Field(default="euler", description="Integration method.")
+    num_steps: int | None = Field(default=None, ge=1, description="Number of integration steps. If None, the model's num_inference_timesteps.")
+    time_power: float = Field(default=1.0, gt=0, description="Exponent of the time grid, 1 for uniform steps.")
+
+
+class ODESolver:
+    """Base class of the solvers: the time grid, and integration from a step of it."""
+
+    def __init__(self, num_steps: int, time_power: float = 1.0):
+        self.num_steps = num_steps
+        if time_power == 1.0:
+            # The same floats as the original Euler loop: t_i = i / N and dt = 1 / N
+            self.times = [i / float(num_steps) for i in range(num_steps + 1)]
+            self.dts = [1.0 / num_steps] * num_steps
+        else:
+            self.times = [(i / num_steps) ** time_power for i in range(num_steps + 1)]
+            self.dts = [t_next - t for t, t_next in zip(self.times, self.times[1:])]
+
+    def start_step(self, t0: float) -> int:
+        """Last step of the grid starting at or before t0, to warm start from t0."""
+        return max(i for i in range(self.num_steps) if self.times[i] <= t0)
+
+    def evaluation_times(self, start_step: int = 0) -> list[float]:
+        """Times at which the velocity is evaluated, in order."""
+        raise NotImplementedError
+
+    def step(self, velocity: Callable, x: torch.Tensor, i: int) -> torch.Tensor:
+        raise NotImplementedError
+
+    def integrate(self, velocity: Callable, x: torch.Tensor, start_step: int = 0) -> torch.Tensor:
+        """
+        Integrate from `times[start_step]` to 1. `velocity(x, t)` returns dx/dt
+        as a new tensor, which the solver may modify. `x` may be updated in place.
+        """
+        for i in range(start_step, self.num_steps):
+            x = self.step(velocity, x, i)
+        return x
+
+
+class EulerSolver(ODESolver):
+    def evaluation_times(self, start_step=0):
+        return self.times[start_step:-1]
+
+    def step(self, velocity, x, i):
+        # In place, the same floats as x + dt * v
+        return x.add_(velocity(x, self.times[i]).mul_(self.dts[i]))
+
+
+class HeunSolver(ODESolver):
+    def evaluation_times(self, start_step=0):
+        times = []
+        for i in range(start_step, self.num_steps):
+            times.append(self.times[i])
+            if i < self.num_steps - 1:
+                times.append(self.times[i + 1])
+        return times
+
+    def step(self, velocity, x, i):
+        dt = self.dts[i]
+        v = velocity(x, self.times[i])
+        x_next = x + dt * v
+        if i == self.num_steps - 1:
+            return x_next
+        return x + dt * 0.5 * (v + velocity(x_next, self.times[i + 1]))
+
+
+class MidpointSolver(ODESolver):
+    def evaluation_times(self, start_step=0):
+        times = []
+        for i in range(start_step, self.num_steps):
+            times += [self.times[i], self.times[i] + 0.5 * self.dts[i]]
+        return times
+
+    def step(self, velocity, x, i):
+        dt = self.dts[i]
+        x_mid = x + 0.5 * dt * velocity(x, self.times[i])
+        return x + dt * velocity(x_mid, self.times[i] + 0.5 * dt)
+
+
+SOLVERS = {
+    "euler": EulerSolver,
+    "heun": HeunSolver,
+    "midpoint": MidpointSolver,
+}
+
+
+def get_solver(config: SolverConfig | None, default_num_steps: int) -> ODESolver:
+    """Solver for `config`, by default Euler with `default_num_steps` uniform steps."""
+    if config is None:
+        config = SolverConfig()
+    num_steps = config.num_steps if config.num_steps is not None else default_num_steps
+    return SOLVERS[config.method](num_steps, config.time_power)
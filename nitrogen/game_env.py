@@ -381,7 +381,10 @@ class GamepadEnv(Env):
     controller_type (str): Platform for the gamepad emulator ("xbox" or "ps4").
     game_speed (float): Speed multiplier for the game.
     env_fps (int): Number of actions to perform per second at normal speed.
-    async_mode (bool): Whether to pause/unpause the game during each step.
+    async_mode (bool): Whether the game keeps running between steps. By default the
+        game is unpaused for the duration of each step and paused again after it,
+        so it waits for the agent. In async mode it is never paused by `step`, and
+        steps are paced at `env_fps` so that the agent can act while it predicts.
     """
 
     def __init__(
@@ -392,7 +395,7 @@ class GamepadEnv(Env):
             controller_type="xbox",
             game_speed=1.0,
             env_fps=10,
-            async_mode=True,
+            async_mode=False,
             screenshot_backend="dxcam",
     ):
         super().__init__()
@@ -410,6 +413,8 @@ class GamepadEnv(Env):
         self.env_fps = env_fps
         self.step_duration = self.calculate_step_duration()
         self.async_mode = async_mode
+        # End of the last step in async mode, the next step is paced from it
+        self.last_step_end = None
 
         self.gamepad_emulator = GamepadEmulator(controller_type=controller_type, system=os_name)
         proc_info = get_process_info(game)
@@ -516,6 +521,20 @@ class GamepadEnv(Env):
         """
         self.gamepad_emulator.step(action)
         start = time.perf_counter()
+        if self.async_mode:
+            # The game is running, so wait for the end of this step on a fixed grid,
+            # rendering time is not added to the step unless the agent falls behind
+            if self.last_step_end is not None and start - self.last_step_end < duration:
+                start = self.last_step_end
+            end = start + duration
+            # Sleep rather than spin through most of the step, so that the thread
+            # waiting for the next prediction gets to run
+            time.sleep(max(0.0, end - time.perf_counter() - 0.001))
+            now = time.perf_counter()
+            while now < end:
+                now = time.perf_counter()
+            self.last_step_end = end
+            return
         self.unpause()
         # Wait until the next step
         end = start + self.step_duration
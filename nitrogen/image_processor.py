@@ -0,0 +1,130 @@
+import warnings
+from typing import Literal
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pydantic import BaseModel, Field
+from torch import nn
+from transformers import AutoImageProcessor
+
+# PIL resampling filter ids, as stored in HF image processor configs
+_PIL_RESAMPLE = {0: "nearest", 2: "bilinear", 3: "bicubic"}
+
+
+class ImageProcessorConfig(BaseModel):
+    do_resize: bool = Field(default=True, description="Whether to resize frames to (height, width).")
+    height: int = Field(default=256, description="Target height in pixels.")
+    width: int = Field(default=256, description="Target width in pixels.")
+    resample: Literal["nearest", "bilinear", "bicubic"] = Field(default="bicubic", description="Resampling filter used for resizing.")
+    do_rescale: bool = Field(default=True, description="Whether to rescale pixel values by rescale_factor.")
+    rescale_factor: float = Field(default=1 / 255, description="Scale applied to uint8 pixel values.")
+    do_normalize: bool = Field(default=True, description="Whether to normalize with image_mean and image_std.")
+    image_mean: list[float] = Field(default=[0.5, 0.5, 0.5], description="Per-channel mean.")
+    image_std: list[float] = Field(default=[0.5, 0.5, 0.5], description="Per-channel standard deviation.")
+
+    @classmethod
+    def from_hf(cls, processor) -> "ImageProcessorConfig":
+        """Build the config from a HF image processor, e.g. a SiglipImageProcessor."""
+        resample = int(processor.resample)
+        if resample not in _PIL_RESAMPLE:
+            raise ValueError(f"Unsupported resampling filter: {processor.resample}")
+        return cls(
+            do_resize=processor.do_resize,
+            height=processor.size["height"],
+            width=processor.size["width"],
+            resample=_PIL_RESAMPLE[resample],
+            do_rescale=processor.do_rescale,
+            rescale_factor=processor.rescale_factor,
+            do_normalize=processor.do_normalize,
+            image_mean=list(processor.image_mean),
+            image_std=list(processor.image_std),
+        )
+
+
+def get_image_processor_config(vision_encoder_name: str) -> ImageProcessorConfig:
+    """
+    Read the preprocessing parameters of a pretrained vision encoder from its HF
+    image processor. Used for checkpoints that do not store them.
+    """
+    return ImageProcessorConfig.from_hf(AutoImageProcessor.from_pretrained(vision_encoder_name))
+
+
+class ImageProcessor(nn.Module):
+    """
+    Vectorized torch replacement for the HF image processor used at inference.
+
+    Takes uint8 RGB frames in HWC layout, either a single frame (H, W, 3) or a
+    batch (N, H, W, 3), as numpy arrays, torch tensors, PIL images or a list of
+    those. Returns `pixel_values` of shape (N, 3, height, width) on the device
+    of the module, computed in one pass.
+
+    Frames already at the target size match the HF processor exactly. Resized
+    frames go through the same separable uint8 passes as PIL, and stay within
+    one uint8 level of the PIL result, both when downscaling and upscaling.
+    `scripts/bench_image_processor.py` checks this against the HF processor.
+    """
+
+    def __init__(self, config: ImageProcessorConfig):
+        super().__init__()
+        self.config = config
+        self.register_buffer("lut", torch.from_numpy(self._build_lut(config)), persistent=False)
+
+    @staticmethod
+    def _build_lut(config: ImageProcessorConfig) -> np.ndarray:
+        """
+        Rescaled and normalized value of every uint8 level, per channel. Computed
+        with the same dtypes as the HF processor (rescale in float64, cast to
+        float32, normalize in float32) so that lookups match it bit for bit.
+        """
+        levels = np.arange(256, dtype=np.float64)
+        if config.do_rescale:
+            levels = levels * config.rescale_factor
+        lut = np.stack([levels.astype(np.float32)] * 3)  # (3, 256)
+        if config.do_normalize:
+            mean = np.array(config.image_mean, dtype=np.float32)[:, None]
+            std = np.array(config.image_std, dtype=np.float32)[:, None]
+            lut = (lut - mean) / std
+        return lut
+
+    def _to_tensor(self, images) -> torch.Tensor:
+        if isinstance(images, (list, tuple)):
+            images = np.stack([np.asarray(image) for image in images])
+        if not isinstance(images, torch.Tensor):
+            images = np.asarray(images)
+            if any(stride < 0 for stride in images.strides):
+                # e.g. BGR to RGB flips, torch has no negative strides
+                images = np.ascontiguousarray(images)
+            with warnings.catch_warnings():
+                # Frames received by the server and arrays viewing a PIL image are
+                # read-only. They are wrapped without a copy, nothing writes to them
+                warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+                images = torch.from_numpy(images)
+        if images.ndim == 3:
+            images = images.unsqueeze(0)
+        if images.ndim != 4 or images.shape[-1] != 3:
+            raise ValueError(f"Expected frames of shape (H, W, 3) or (N, H, W, 3), got {tuple(images.shape)}")
+        return images.to(self.lut.device, non_blocking=True)
+
+    @torch.no_grad()
+    def forward(self, images) -> torch.Tensor:
+        cfg = self.config
+        pixel_values = self._to_tensor(images).permute(0, 3, 1, 2)
+
+        if cfg.do_resize and tuple(pixel_values.shape[-2:]) != (cfg.height, cfg.width):
+            # Separable like PIL, which resizes in uint8: the horizontal pass is
+            # rounded and clipped before the vertical one. Clipping in between
+            # matters when upscaling, where bicubic overshoots on sharp edges.
+            pixel_values = pixel_values.float()
+            for size in [(pixel_values.shape[-2], cfg.width), (cfg.height, cfg.width)]:
+                if tuple(pixel_values.shape[-2:]) != size:
+                    pixel_values = F.interpolate(
+                        pixel_values,
+                        size=size,
+                        mode=cfg.resample,
+                        antialias=cfg.resample != "nearest",
+                    ).round().clamp(0, 255)
+
+        # Rescale and normalize in a single lookup
+        channels = torch.arange(3, device=self.lut.device).view(1, 3, 1, 1)
+        return self.lut[channels, pixel_values.long()]
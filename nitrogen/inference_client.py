@@ -1,85 +1,159 @@
 import time
-import pickle
+import uuid
 
 import numpy as np
 import zmq
 
+from nitrogen.protocol import SharedMemoryRing, default_ipc_path, pack, unpack
+
+# Size of the reply slots, action chunks are a few KB
+REPLY_SLOT_BYTES = 1 << 16
+
 class ModelClient:
     """Client for model inference server."""
     
-    def __init__(self, host="localhost", port=5555):
+    def __init__(self, host="localhost", port=5555, session_id=None, transport="tcp", ipc_path=None, ring_slots=4):
         """
         Initialize client connection.
         
         Args:
             host: Server hostname or IP
             port: Server port
+            session_id: ID of the server-side session holding this client's frame
+                history. Clients using the same ID share it, e.g. to resume a
+                session after reconnecting. Defaults to a new random ID.
+            transport: "tcp", or "shm" when the server runs on the same host
+                with `--ipc`. In shm mode requests go over the server's ipc
+                endpoint, and frames and action chunks are passed through
+                shared memory rings, so only slot indices go through ZMQ.
+            ipc_path: Path of the server's ipc endpoint in shm mode. Defaults to
+                the path the server derives from its port.
+            ring_slots: Number of slots of the shared memory rings.
         """
+        assert transport in ["tcp", "shm"], "Transport must be either 'tcp' or 'shm'"
         self.host = host
         self.port = port
+        self.session_id = session_id if session_id is not None else uuid.uuid4().hex
+        self.transport = transport
+        self.ring_slots = ring_slots
+        self.request_ring = None
+        self.reply_ring = None
+        self.seq = 0
         self.timeout_ms = 30000
 
+        if transport == "shm":
+            endpoint = f"ipc://{ipc_path if ipc_path is not None else default_ipc_path(port)}"
+        else:
+            endpoint = f"tcp://{host}:{port}"
+
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect(f"tcp://{host}:{port}")
+        self.socket.connect(endpoint)
         self.socket.setsockopt(zmq.RCVTIMEO, self.timeout_ms)  # Set receive timeout
+        # Frames below 1MB are cheaper to copy than to track for zero-copy sends
+        self.socket.copy_threshold = 1 << 20
         
-        print(f"Connected to model server at {host}:{port}")
+        print(f"Connected to model server at {endpoint} (session {self.session_id})")
+
+    def _request(self, header: dict, arrays: dict | None = None):
+        """Send a request and return the (header, arrays) of the response."""
+        self.seq += 1
+        header = {**header, "session": self.session_id, "seq": self.seq}
+        self.socket.send_multipart(pack(header, arrays), copy=False)
+        response, response_arrays = unpack(self.socket.recv_multipart())
+
+        if response["status"] != "ok":
+            raise RuntimeError(f"Server error: {response.get('message', 'Unknown error')}")
+        if response.get("seq") != self.seq:
+            raise RuntimeError(f"Response to request {response.get('seq')} received for request {self.seq}")
+        return response, response_arrays
     
-    def predict(self, image: np.ndarray) -> dict:
+    def predict(self, image: np.ndarray, solver: dict | None = None) -> dict:
         """
         Send an image and receive predicted actions.
         
         Args:
-            image: numpy array (H, W, 3) in RGB format
+            image: uint8 numpy array (H, W, 3) in RGB format, or a PIL image.
+                The pixels are sent as a raw buffer, without copying arrays
+                that are already contiguous.
+            solver: ODE solver for this prediction, as the fields of a
+                `SolverConfig`, e.g. {"method": "heun", "num_steps": 4}.
+                Defaults to the server's solver.
             
         Returns:
-            List of action dicts, each containing:
+            Dict of the action chunk arrays, writable and owned by the caller
+            with both transports:
                 - j_left: [x, y] left joystick position
                 - j_right: [x, y] right joystick position  
                 - buttons: list of button values
         """
-        request = {
-            "type": "predict",
-            "image": image
-        }
-        
-        self.socket.send(pickle.dumps(request))
-        response = pickle.loads(self.socket.recv())
-        
-        if response["status"] != "ok":
-            raise RuntimeError(f"Server error: {response.get('message', 'Unknown error')}")
-        
-        return response["pred"]
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 image, got {image.dtype}")
+
+        request = {"type": "predict"}
+        if solver is not None:
+            request["solver"] = solver
+        if self.transport == "shm":
+            return self._predict_shared_memory(request, image)
+        _, pred = self._request(request, {"image": image})
+        # Own the chunk like in shm mode, the arrays are read-only views of the reply frames
+        return {k: v.copy() for k, v in pred.items()}
+
+    def _predict_shared_memory(self, request, image):
+        if self.request_ring is None or not self.request_ring.fits({"image": image}):
+            self._attach_rings(image.nbytes)
+
+        slot = self.request_ring.acquire()
+        specs = self.request_ring.write(slot, {"image": image})
+        response, pred = self._request({**request, "slot": slot, "shm_arrays": specs})
+        if "shm_arrays" in response:
+            pred = self.reply_ring.read(response["slot"], response["shm_arrays"])
+        # Own the chunk: the slot is reused `ring_slots` predictions later, and
+        # replies too large for it come back as read-only views of the frames
+        return {k: v.copy() for k, v in pred.items()}
+
+    def _attach_rings(self, frame_bytes):
+        """Create rings sized for frames of `frame_bytes` and attach the server session to them."""
+        old_rings = (self.request_ring, self.reply_ring)
+        new_rings = (SharedMemoryRing(self.ring_slots, frame_bytes), SharedMemoryRing(self.ring_slots, REPLY_SLOT_BYTES))
+        try:
+            self._request({
+                "type": "attach_shm",
+                "request_ring": new_rings[0].spec(),
+                "reply_ring": new_rings[1].spec(),
+            })
+        except Exception:
+            for ring in new_rings:
+                ring.close()
+            raise
+        # The server has switched to the new rings
+        self.request_ring, self.reply_ring = new_rings
+        for ring in old_rings:
+            if ring is not None:
+                ring.close()
     
     def reset(self):
-        """Reset the server's session (clear buffers)."""
-        request = {"type": "reset"}
-        
-        self.socket.send(pickle.dumps(request))
-        response = pickle.loads(self.socket.recv())
-        
-        if response["status"] != "ok":
-            raise RuntimeError(f"Server error: {response.get('message', 'Unknown error')}")
-        
+        """Reset this client's session on the server (clear buffers)."""
+        self._request({"type": "reset"})
         print("Session reset")
 
+    def select_game(self, game: str | None):
+        """Select the game this client's session is conditioned on (None for unconditional)."""
+        self._request({"type": "select_game", "game": game})
+
     def info(self) -> dict:
         """Get session info from the server."""
-        request = {"type": "info"}
-        
-        self.socket.send(pickle.dumps(request))
-        response = pickle.loads(self.socket.recv())
-        
-        if response["status"] != "ok":
-            raise RuntimeError(f"Server error: {response.get('message', 'Unknown error')}")
-        
+        response, _ = self._request({"type": "info"})
         return response["info"]
 
     def close(self):
         """Close the connection."""
         self.socket.close()
         self.context.term()
+        for ring in (self.request_ring, self.reply_ring):
+            if ring is not None:
+                ring.close()
         print("Connection closed")
     
     def __enter__(self):
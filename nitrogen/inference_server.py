@@ -0,0 +1,338 @@
+import os
+import time
+import traceback
+from collections import deque, namedtuple, OrderedDict
+
+import numpy as np
+import zmq
+from pydantic import ValidationError
+
+from nitrogen.inference_session import InferenceSession
+from nitrogen.flow_matching_transformer.solvers import SolverConfig
+from nitrogen.protocol import ProtocolError, SharedMemoryRing, pack, unpack
+
+# A queued predict request. `slot` is the shared memory slot of the frame, or None,
+# and `solver` the SolverConfig requested by the client, or None for the session's
+PendingPredict = namedtuple("PendingPredict", ["client_id", "session_id", "seq", "image", "slot", "solver"])
+
+
+class InferenceServer:
+    """
+    ZMQ server that batches predict requests across clients.
+
+    The server binds a ROUTER socket, so any number of `ModelClient`s (REQ
+    sockets) can connect to it. Messages use the binary protocol of
+    `nitrogen.protocol`: frames arrive as raw uint8 buffers and action chunks
+    are returned as raw float buffers. Requests carry a session ID, and each session
+    ID gets its own InferenceSession forked from `session`: frame buffers and
+    the selected game are per session while the model weights are shared.
+    Requests without a session ID, from older clients, use the identity of
+    their socket instead.
+
+    With `ipc_path`, the server also listens on that ipc endpoint for clients
+    on the same host. Such clients can attach their session to shared memory
+    rings: they write frames into the request ring and send only slot indices,
+    the server reads the frames in place and writes action chunks into the
+    reply ring.
+
+    At most `max_sessions` sessions are kept. Sessions that have not been used
+    for `session_timeout_s` seconds are evicted; a new session is refused
+    while the table is full of active ones.
+
+    Predict requests are collected into a batch that is closed when it holds
+    `max_batch_size` requests, when every active session, i.e. one that sent a
+    predict request in the last `active_window_s` seconds, has a request
+    pending, or `batch_timeout_ms` after its first request arrived, whichever
+    comes first. A client that stops predicting thus delays the batches of the
+    others for `active_window_s` at most, not until its session is evicted. The batch then runs as one `InferenceSession.predict_batch` call and
+    each result is routed back to its caller. Other requests are answered right
+    away. Predict requests may pick their own ODE solver; only requests with
+    the same solver are batched together.
+    """
+
+    def __init__(
+        self,
+        session: InferenceSession,
+        port: int = 5555,
+        max_batch_size: int = 8,
+        batch_timeout_ms: float = 5.0,
+        max_sessions: int = 64,
+        session_timeout_s: float = 600.0,
+        active_window_s: float = 1.0,
+        ipc_path: str | None = None,
+    ):
+        self.session = session
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.max_sessions = max_sessions
+        self.session_timeout_s = session_timeout_s
+        self.active_window_s = active_window_s
+        self.ipc_path = ipc_path
+
+        # session ID -> (InferenceSession, last use time), least recently used first
+        self.sessions = OrderedDict()
+        # session ID -> time of its last predict request
+        self.last_predict = {}
+        # session ID -> (request ring, reply ring) of sessions using shared memory
+        self.rings = {}
+        # (session ID, rings) replaced or evicted while queued frames still view them
+        self.detached_rings = []
+        self.pending = []  # PendingPredict
+        self.batch_deadline = None
+        # Sizes of recent batches, reported by info()
+        self.batch_sizes = deque(maxlen=100)
+
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(f"tcp://*:{port}")
+        if ipc_path is not None:
+            if os.path.exists(ipc_path):
+                # Left over by a server that did not shut down cleanly
+                os.remove(ipc_path)
+            self.socket.bind(f"ipc://{ipc_path}")
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def get_session(self, session_id) -> InferenceSession:
+        """Return the session with this ID, creating it if needed, and mark it as used."""
+        if session_id in self.sessions:
+            session, _ = self.sessions.pop(session_id)
+        else:
+            self.evict_idle_sessions()
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError(f"Session limit reached ({self.max_sessions} active sessions)")
+            session = self.session.fork()
+            print(f"New session {session_id} ({len(self.sessions) + 1} active)")
+        self.sessions[session_id] = (session, time.monotonic())
+        return session
+
+    def evict_idle_sessions(self):
+        # Sessions with queued requests were just used, so they are never evicted here
+        now = time.monotonic()
+        while len(self.sessions) > 0:
+            session_id, (_, last_used) = next(iter(self.sessions.items()))
+            if now - last_used < self.session_timeout_s:
+                break
+            del self.sessions[session_id]
+            self.last_predict.pop(session_id, None)
+            self.detach_rings(session_id)
+            print(f"Evicted idle session {session_id} ({len(self.sessions)} active)")
+
+    def attach_rings(self, session_id, request: dict):
+        rings = []
+        try:
+            for key in ["request_ring", "reply_ring"]:
+                rings.append(SharedMemoryRing.attach(request[key]))
+        except (KeyError, ProtocolError):
+            for ring in rings:
+                ring.close()
+            raise
+        self.detach_rings(session_id)
+        self.rings[session_id] = tuple(rings)
+
+    def detach_rings(self, session_id):
+        if session_id in self.rings:
+            self.detached_rings.append((session_id, self.rings.pop(session_id)))
+        self.close_detached_rings()
+
+    def close_detached_rings(self):
+        # The frames of queued shared memory requests are views of their session's
+        # request ring, which cannot be closed under them. Such rings are kept open
+        # until the session has no such request left
+        if len(self.detached_rings) == 0:
+            return
+        busy = {request.session_id for request in self.pending if request.slot is not None}
+        kept = []
+        for session_id, rings in self.detached_rings:
+            if session_id in busy:
+                kept.append((session_id, rings))
+            else:
+                for ring in rings:
+                    ring.close()
+        self.detached_rings = kept
+
+    def info(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "batch_timeout_ms": self.batch_timeout_ms,
+            "num_sessions": len(self.sessions),
+            "max_sessions": self.max_sessions,
+            "session_timeout_s": self.session_timeout_s,
+            "active_window_s": self.active_window_s,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else None,
+        }
+
+    def send(self, client_id: bytes, seq, response: dict, arrays: dict | None = None):
+        self.socket.send_multipart([client_id, b"", *pack({**response, "seq": seq}, arrays)], copy=False)
+
+    def handle(self, client_id: bytes, request: dict, arrays: dict):
+        """Answer a request right away, or queue it if it is a predict request."""
+        session_id = request.get("session", client_id.hex())
+        seq = request.get("seq")
+        if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+            self.send(client_id, None, {"status": "error", "message": f"Invalid seq {seq!r}"})
+            return
+        if not isinstance(session_id, str):
+            self.send(client_id, seq, {"status": "error", "message": f"Invalid session ID {session_id!r}"})
+            return
+        if request.get("type") not in ("reset", "info", "select_game", "attach_shm", "predict"):
+            self.send(client_id, seq, {"status": "error", "message": f"Unknown request type: {request.get('type')}"})
+            return
+        try:
+            session = self.get_session(session_id)
+        except RuntimeError as e:
+            self.send(client_id, seq, {"status": "error", "message": str(e)})
+            return
+
+        if request["type"] == "reset":
+            session.reset()
+            self.send(client_id, seq, {"status": "ok"})
+            print(f"Session {session_id} reset")
+        elif request["type"] == "info":
+            info = session.info()
+            info["server"] = self.info()
+            self.send(client_id, seq, {"status": "ok", "info": info})
+            print(f"Sent session {session_id} info")
+        elif request["type"] == "select_game":
+            try:
+                session.select_game(request.get("game"))
+            except ValueError as e:
+                self.send(client_id, seq, {"status": "error", "message": str(e)})
+                return
+            self.send(client_id, seq, {"status": "ok"})
+            print(f"Session {session_id} selected game {request.get('game')}")
+        elif request["type"] == "attach_shm":
+            try:
+                self.attach_rings(session_id, request)
+            except (KeyError, ProtocolError) as e:
+                self.send(client_id, seq, {"status": "error", "message": f"Cannot attach shared memory: {e}"})
+                return
+            self.send(client_id, seq, {"status": "ok"})
+            print(f"Session {session_id} attached to shared memory")
+        elif request["type"] == "predict":
+            slot = request.get("slot")
+            if slot is not None:
+                if session_id not in self.rings:
+                    self.send(client_id, seq, {"status": "error", "message": "Session is not attached to shared memory"})
+                    return
+                try:
+                    arrays = self.rings[session_id][0].read(slot, request.get("shm_arrays", []))
+                except ProtocolError as e:
+                    self.send(client_id, seq, {"status": "error", "message": str(e)})
+                    return
+            image = arrays.get("image")
+            if image is None or image.dtype != np.uint8:
+                self.send(client_id, seq, {"status": "error", "message": "Predict requests need a uint8 image"})
+                return
+            solver = request.get("solver")
+            if solver is not None:
+                try:
+                    solver = SolverConfig.model_validate(solver)
+                except ValidationError as e:
+                    self.send(client_id, seq, {"status": "error", "message": f"Invalid solver: {e}"})
+                    return
+            if len(self.pending) == 0:
+                self.batch_deadline = time.perf_counter() + self.batch_timeout_ms / 1000
+            self.pending.append(PendingPredict(client_id, session_id, seq, image, slot, solver))
+            self.last_predict[session_id] = time.perf_counter()
+
+    def receive(self):
+        """Handle every message waiting on the socket without blocking."""
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            client_id = frames[0].bytes
+            try:
+                request, arrays = unpack(frames[2:])
+            except ProtocolError as e:
+                self.send(client_id, None, {"status": "error", "message": str(e)})
+                continue
+            try:
+                self.handle(client_id, request, arrays)
+            except Exception as e:
+                # A malformed request must not take the server down for the other clients
+                traceback.print_exc()
+                self.send(client_id, request.get("seq"), {"status": "error", "message": f"Invalid request: {e}"})
+
+    def batch_ready(self) -> bool:
+        if len(self.pending) == 0:
+            return False
+        now = time.perf_counter()
+        num_active = sum(now - last < self.active_window_s for last in self.last_predict.values())
+        if len(self.pending) >= min(self.max_batch_size, num_active):
+            return True
+        return now >= self.batch_deadline
+
+    def run_batch(self):
+        # A session can only appear once per batch, and a batch runs a single
+        # solver, the one of its first request. Other requests wait for the next one
+        batch, remaining, session_ids = [], [], set()
+        solver = self.pending[0].solver
+        for request in self.pending:
+            if request.session_id in session_ids or request.solver != solver or len(batch) >= self.max_batch_size:
+                remaining.append(request)
+            else:
+                batch.append(request)
+                session_ids.add(request.session_id)
+        self.pending = remaining
+        if len(self.pending) > 0:
+            self.batch_deadline = time.perf_counter() + self.batch_timeout_ms / 1000
+
+        start_time = time.perf_counter()
+        try:
+            sessions = [self.get_session(request.session_id) for request in batch]
+            results = self.predict_batch(sessions, [request.image for request in batch], solver)
+        except Exception as e:
+            traceback.print_exc()
+            for request in batch:
+                self.send(request.client_id, request.seq, {"status": "error", "message": str(e)})
+            return
+
+        for request, result in zip(batch, results):
+            self.send_result(request, result)
+        self.batch_sizes.append(len(batch))
+        print(f"Batch of {len(batch)}: {time.perf_counter() - start_time:.3f}s")
+
+    def predict_batch(self, sessions, images, solver=None):
+        return InferenceSession.predict_batch(sessions, images, solver)
+
+    def send_result(self, request: PendingPredict, result: dict):
+        # Replies go into the reply ring slot matching the frame's slot, or as frames if they do not fit
+        reply_ring = self.rings[request.session_id][1] if request.session_id in self.rings else None
+        if request.slot is not None and reply_ring is not None and request.slot < reply_ring.num_slots and reply_ring.fits(result):
+            specs = reply_ring.write(request.slot, result)
+            self.send(request.client_id, request.seq, {"status": "ok", "slot": request.slot, "shm_arrays": specs})
+        else:
+            self.send(request.client_id, request.seq, {"status": "ok"}, result)
+
+    def serve_forever(self):
+        print(f"\n{'='*60}")
+        print(f"Server running on port {self.port}")
+        if self.ipc_path is not None:
+            print(f"Listening for clients on this host at ipc://{self.ipc_path}")
+        print(f"Batching up to {self.max_batch_size} requests within {self.batch_timeout_ms}ms")
+        print(f"Waiting for requests...")
+        print(f"{'='*60}\n")
+
+        while True:
+            # Poll with 100ms timeout to allow interrupt handling, or until the open batch is due
+            timeout = 100
+            if len(self.pending) > 0:
+                timeout = max(0, min(timeout, (self.batch_deadline - time.perf_counter()) * 1000))
+            events = dict(self.poller.poll(timeout=timeout))
+            if self.socket in events:
+                self.receive()
+            while self.batch_ready():
+                self.run_batch()
+            self.close_detached_rings()
+            self.evict_idle_sessions()
+
+    def close(self):
+        self.pending = []
+        for session_id in list(self.rings):
+            self.detach_rings(session_id)
+        self.socket.close()
+        self.context.term()
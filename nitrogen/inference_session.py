@@ -1,14 +1,21 @@
+import os
 import time
 import json
+import warnings
+import itertools
 from collections import deque
+from pathlib import Path
 
 import torch
 import numpy as np
+from safetensors.torch import load_file
+from transformers.modeling_utils import no_init_weights
 
-from transformers import AutoImageProcessor
-from nitrogen.flow_matching_transformer.nitrogen import NitroGen, NitroGen_Config
+from nitrogen.flow_matching_transformer.nitrogen import NitroGen, NitroGen_Config, get_vision_encoder_config
+from nitrogen.flow_matching_transformer.solvers import SolverConfig
 from nitrogen.mm_tokenizers import NitrogenTokenizerConfig, NitrogenTokenizer, Tokenizer
 from nitrogen.cfg import CkptConfig
+from nitrogen.image_processor import ImageProcessor, get_image_processor_config
 from nitrogen.shared import PATH_REPO
 
 def summarize_parameters(module, name='model', depth=0, max_depth=3):
@@ -38,18 +45,182 @@ def summarize_parameters(module, name='model', depth=0, max_depth=3):
             summarize_parameters(child_module, child_name, depth + 1, max_depth)
 
 
-def load_model(checkpoint_path: str):
-    """Load model and args from checkpoint."""
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bf16 matmul support (AVX512-BF16 or AMX)."""
+    checks = ["_is_avx512_bf16_supported", "_is_amx_tile_supported"]
+    return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
+
+
+def get_autocast(device: torch.device, enabled: bool = True):
+    """bf16 autocast on CUDA, and on CPUs that support it. Plain fp32 otherwise, or if not `enabled`."""
+    if device.type == "cuda":
+        return torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=enabled)
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled and cpu_supports_bf16())
+
+
+# Submodules whose nn.Linear layers are quantized: SigLIP tower, VL mixing and DiT
+QUANTIZED_SUBMODULES = ("vision_encoder", "vl_self_attention_model", "model")
+
+
+def quantize_model(model, quantization: str):
+    """
+    Quantize the nn.Linear layers of QUANTIZED_SUBMODULES in place, for CPU
+    inference. "int8" is dynamic quantization: int8 weights with a scale per
+    output channel, and activations quantized to int8 on the fly. Quantized
+    layers compute in fp32, so the model runs without bf16 autocast.
+    """
+    if quantization != "int8":
+        raise ValueError(f"Unsupported quantization: {quantization}")
+    # The timestep conditioning of the DiT is computed once per sampling schedule,
+    # see NitroGen.timestep_table, so its linear layers stay in full precision
+    dit = model.model
+    timestep_modules = [dit.timestep_encoder, dit.proj_out_1] + [block.norm1 for block in dit.transformer_blocks]
+    skipped = {id(m) for module in timestep_modules for m in module.modules()}
+    with warnings.catch_warnings():
+        # Eager mode quantization is deprecated in favor of torchao, which is not a dependency
+        warnings.simplefilter("ignore")
+        for name in QUANTIZED_SUBMODULES:
+            submodule = getattr(model, name)
+            # Exact type match: the out_proj of nn.MultiheadAttention subclasses nn.Linear
+            # but is called through its weight by the attention, and cannot be quantized
+            qconfig_spec = {
+                linear_name: torch.ao.quantization.per_channel_dynamic_qconfig
+                for linear_name, linear in submodule.named_modules()
+                if type(linear) is torch.nn.Linear and id(linear) not in skipped
+            }
+            torch.ao.quantization.quantize_dynamic(submodule, qconfig_spec, dtype=torch.qint8, inplace=True)
+    model.quantization = quantization
+    model.timestep_tables.clear()
+    return model
+
+
+def compile_model(model, cache_dir: str | None = None):
+    """
+    Compile the SigLIP tower, the VL mixing transformer and the DiT blocks with
+    torch.compile, in place. Graphs are first specialized to the shapes they
+    are called with. A dimension that changes between calls, the batch size
+    (doubled by batched CFG) or the VL sequence length with
+    `drop_vl_padding`, is recompiled once as dynamic, and later sizes reuse
+    that graph instead of recompiling up to the cache size limit and falling
+    back to eager. `InferenceSession.warm_up` goes through these compilations
+    before serving. The DiT is compiled per block, as its forward fills the
+    cross-attention K/V cache, and the blocks share one graph.
+
+    With `cache_dir`, Inductor caches the compiled graphs and kernels there
+    and later processes load them instead of compiling again. The directory
+    can be shared by the replicas of a deployment.
+    """
+    if cache_dir is not None:
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(Path(cache_dir).resolve())
+    model.vision_encoder.compile()
+    model.vl_self_attention_model.compile()
+    for block in model.model.transformer_blocks:
+        block.compile()
+    model.compiled = True
+    return model
+
+
+def resolve_device(device: str | None = None) -> torch.device:
+    """Default to CUDA when available, CPU otherwise."""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def load_checkpoint(checkpoint_path: str):
+    """
+    Read a checkpoint and return (ckpt_config, state_dict, mmap).
+
+    Two formats are supported:
+    - a torch pickle holding both `ckpt_config` and `model`, as saved by training.
+    - a `.safetensors` file holding the weights, next to a `.json` sidecar holding
+      the CkptConfig, as written by `scripts/convert_ckpt.py --format safetensors`.
+      The weights are memory-mapped (`mmap=True`): they page in lazily and
+      processes on the same host share them through the page cache.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if checkpoint_path.suffix == ".safetensors":
+        with open(checkpoint_path.with_suffix(".json"), "r") as f:
+            ckpt_config = json.load(f)
+        return ckpt_config, load_file(checkpoint_path, device="cpu"), True
+
     checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
-    ckpt_config = CkptConfig.model_validate(checkpoint["ckpt_config"])
+    return checkpoint["ckpt_config"], checkpoint["model"], False
+
+
+def init_non_persistent_buffers(model):
+    """
+    Non-persistent buffers are not part of the state dict, so they are still on
+    the meta device after loading into a model built on it. Recreate them.
+    """
+    embeddings = model.vision_encoder.embeddings
+    if getattr(embeddings, "position_ids", None) is not None and embeddings.position_ids.is_meta:
+        position_ids = torch.arange(embeddings.num_positions).expand((1, -1))
+        embeddings.register_buffer("position_ids", position_ids, persistent=False)
+
+    missing = [
+        name for name, tensor in itertools.chain(model.named_parameters(), model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f"Tensors not initialized by the checkpoint: {missing}")
+
+
+def load_model(
+    checkpoint_path: str,
+    device: str | None = None,
+    num_threads: int | None = None,
+    quantization: str | None = None,
+    compile: bool = False,
+    compile_cache_dir: str | None = None,
+):
+    """
+    Load model and args from checkpoint.
+
+    Args:
+        checkpoint_path: Path to the checkpoint
+        device: Device to run inference on, e.g. "cuda", "cuda:1" or "cpu".
+            Defaults to CUDA when available.
+        num_threads: Number of intra-op threads used by torch on CPU. Uses
+            the torch default if None.
+        quantization: "int8" to quantize the linear layers, see quantize_model.
+            CPU only.
+        compile: Compile the model with torch.compile, see compile_model.
+        compile_cache_dir: Directory persisting the compiled graphs across
+            processes.
+    """
+    device = resolve_device(device)
+    if quantization is not None and device.type != "cpu":
+        raise ValueError(f"Quantization is only supported on CPU, not {device}")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    print(f"Running inference on {device} ({torch.get_num_threads()} intra-op threads)")
+    if quantization is not None:
+        print(f"CPU bf16 autocast: disabled, {quantization} quantized layers compute in fp32")
+    elif device.type == "cpu":
+        print(f"CPU bf16 autocast: {'enabled' if cpu_supports_bf16() else 'not supported, using fp32'}")
+
+    ckpt_config, state_dict, mmap = load_checkpoint(checkpoint_path)
+    ckpt_config = CkptConfig.model_validate(ckpt_config)
     model_cfg = ckpt_config.model_cfg
     tokenizer_cfg = ckpt_config.tokenizer_cfg
 
+    if model_cfg.vision_encoder_cfg is None:
+        # Older checkpoints only store the encoder name. Fetch its architecture config
+        # (no weights, served from the HF cache when available) so the encoder is built
+        # without downloading pretrained weights that the checkpoint overwrites anyway.
+        # Run scripts/convert_ckpt.py once to embed it and start without network access.
+        print(f"Checkpoint has no vision encoder config, fetching it for {model_cfg.vision_encoder_name}")
+        model_cfg.vision_encoder_cfg = get_vision_encoder_config(model_cfg.vision_encoder_name)
+    if ckpt_config.image_processor_cfg is None:
+        print(f"Checkpoint has no image processor config, reading it from {model_cfg.vision_encoder_name}")
+        ckpt_config.image_processor_cfg = get_image_processor_config(model_cfg.vision_encoder_name)
+
     print("Checkpoint args:")
     print(json.dumps(ckpt_config.model_dump(), indent=4))
 
     # Initialize tokenizer and language model
-    img_proc = AutoImageProcessor.from_pretrained(model_cfg.vision_encoder_name)
+    img_proc = ImageProcessor(ckpt_config.image_processor_cfg)
 
     # Create VLM with pre-loaded language model
     if isinstance(model_cfg, NitroGen_Config):
@@ -63,7 +234,13 @@ def load_model(checkpoint_path: str):
             ]
         tokenizer = NitrogenTokenizer(tokenizer_cfg)
         game_mapping = tokenizer.game_mapping
-        model = NitroGen(config=model_cfg, game_mapping=game_mapping)
+        if mmap:
+            # Build without allocating or initializing weights, the memory-mapped
+            # checkpoint tensors are adopted as parameters below
+            with torch.device("meta"), no_init_weights():
+                model = NitroGen(config=model_cfg, game_mapping=game_mapping)
+        else:
+            model = NitroGen(config=model_cfg, game_mapping=game_mapping)
         # model.num_inference_timesteps = 16
         action_downsample_ratio = 1
     else:
@@ -73,13 +250,86 @@ def load_model(checkpoint_path: str):
 
     print(model)
 
-    model.load_state_dict(checkpoint["model"])
+    if mmap:
+        model.load_state_dict(state_dict, assign=True)
+        init_non_persistent_buffers(model)
+    else:
+        model.load_state_dict(state_dict)
+    del state_dict
+    # Weights exported in a lower precision stay in it when autocast computes in
+    # that precision anyway, and are upcast otherwise
+    compute_dtype = torch.bfloat16 if quantization is None and (device.type == "cuda" or cpu_supports_bf16()) else torch.float32
+    if model.dtype not in (torch.float32, compute_dtype):
+        print(f"Casting {model.dtype} weights to fp32")
+        model.float()
     model.eval()
     tokenizer.eval()
-    model.to("cuda")
+    model.to(device)
+    img_proc.to(device)
+    if quantization is not None:
+        print(f"Quantizing linear layers of {', '.join(QUANTIZED_SUBMODULES)} to {quantization}")
+        quantize_model(model, quantization)
+    if compile:
+        print(f"Compiling the model, cache: {compile_cache_dir or 'Inductor default'}")
+        compile_model(model, compile_cache_dir)
 
     return model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio
 
+def collate_inputs(batch: list[dict]) -> dict:
+    """
+    Concatenate single-sample model inputs along the batch dimension. Tensors
+    are concatenated, other values are gathered into lists.
+    """
+    collated = {}
+    for key, value in batch[0].items():
+        if isinstance(value, torch.Tensor):
+            collated[key] = torch.cat([data[key] for data in batch], dim=0)
+        else:
+            collated[key] = [v for data in batch for v in data[key]]
+    return collated
+
+
+class FrameFeatureBuffer:
+    """
+    Ring buffer of per-frame vision features, kept on the model device.
+
+    Each predict call only encodes the newest frame and writes its features
+    into the next slot, so vision cost does not grow with the context length.
+    The storage is allocated on the first append and reused after `clear()`.
+    """
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.features = None  # (maxlen, tokens_per_frame, hidden_size)
+        self.next_slot = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @torch.inference_mode()
+    def append(self, frame_features):
+        if self.features is None:
+            self.features = frame_features.new_zeros((self.maxlen, *frame_features.shape))
+        self.features[self.next_slot] = frame_features
+        self.next_slot = (self.next_slot + 1) % self.maxlen
+        self.size = min(self.size + 1, self.maxlen)
+
+    def window(self):
+        """
+        Features of the buffered frames, oldest first, left-padded with zeros
+        to `maxlen` frames. Shape (maxlen, tokens_per_frame, hidden_size).
+        """
+        return torch.roll(self.features, shifts=-self.next_slot, dims=0)
+
+    @torch.inference_mode()
+    def clear(self):
+        if self.features is not None:
+            self.features.zero_()
+        self.next_slot = 0
+        self.size = 0
+
+
 class InferenceSession:
     """Manages state for a single inference session."""
     
@@ -95,8 +345,30 @@ class InferenceSession:
         old_layout: bool,
         cfg_scale: float,
         action_downsample_ratio: float,
-        context_length=None
+        context_length=None,
+        batched_cfg=None,
+        warm_start_t0=None,
+        warm_start_shift=8,
+        solver: SolverConfig | None = None,
+        drop_vl_padding=False,
     ):
+        """
+        `solver` sets the ODE solver of the action head, by default Euler with the
+        model's number of inference timesteps. Single predictions can override it.
+
+        `warm_start_t0` enables warm-started sampling: each prediction starts from
+        the previous action chunk, shifted by `warm_start_shift` actions (the number
+        of actions the client executes between two predictions), noised to time
+        `warm_start_t0`, and only the remaining denoising steps are integrated.
+
+        `drop_vl_padding` drops the padding of the vision-language tokens before VL
+        mixing and cross-attention. It saves compute when the sequence is padded,
+        e.g. with fewer frames than the context length, but deviates slightly from
+        the padded computation the model was trained with.
+
+        `batched_cfg` runs both CFG branches as one batch. By default they are
+        batched on CUDA and run one after the other on CPU, where it is faster.
+        """
         self.model = model
         self.tokenizer = tokenizer
         self.img_proc = img_proc
@@ -105,6 +377,11 @@ class InferenceSession:
         self.selected_game = selected_game
         self.old_layout = old_layout
         self.cfg_scale = cfg_scale
+        self.batched_cfg = batched_cfg if batched_cfg is not None else model.device.type == "cuda"
+        self.warm_start_t0 = warm_start_t0
+        self.warm_start_shift = warm_start_shift
+        self.solver = solver
+        self.drop_vl_padding = drop_vl_padding
         self.action_downsample_ratio = action_downsample_ratio
         self.ckpt_path = ckpt_path
 
@@ -115,14 +392,43 @@ class InferenceSession:
         self.action_interleaving = self.modality_config.action_interleaving
         self.is_flowmatching = isinstance(self.ckpt_config.model_cfg, NitroGen_Config)
 
+        self.device = self.model.device
+        # Rolling window of predict latencies, reported by info()
+        self.latencies = deque(maxlen=100)
+
         # Buffers
-        self.obs_buffer = deque(maxlen=self.max_buffer_size)
+        self.obs_buffer = FrameFeatureBuffer(maxlen=self.max_buffer_size)
         self.action_buffer = deque(maxlen=self.max_buffer_size)
+        # Embedding indices of the token layouts seen so far, see `_embedding_indices`
+        self.embedding_indices = {}
 
     @classmethod
-    def from_ckpt(cls, checkpoint_path: str, old_layout=False, cfg_scale=1.0, context_length=None):
+    def from_ckpt(
+        cls,
+        checkpoint_path: str,
+        old_layout=False,
+        cfg_scale=1.0,
+        context_length=None,
+        batched_cfg=None,
+        device=None,
+        num_threads=None,
+        warm_start_t0=None,
+        warm_start_shift=8,
+        solver=None,
+        drop_vl_padding=False,
+        quantization=None,
+        compile=False,
+        compile_cache_dir=None,
+    ):
         """Create an InferenceSession from a checkpoint."""
-        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = load_model(checkpoint_path)
+        model, tokenizer, img_proc, ckpt_config, game_mapping, action_downsample_ratio = load_model(
+            checkpoint_path,
+            device=device,
+            num_threads=num_threads,
+            quantization=quantization,
+            compile=compile,
+            compile_cache_dir=compile_cache_dir,
+        )
 
         if game_mapping is not None:
             # Ask user to pick a game from the list
@@ -155,7 +461,12 @@ class InferenceSession:
             old_layout,
             cfg_scale,
             action_downsample_ratio,
-            context_length
+            context_length,
+            batched_cfg,
+            warm_start_t0,
+            warm_start_shift,
+            solver,
+            drop_vl_padding,
         )
 
     def info(self):
@@ -164,36 +475,101 @@ class InferenceSession:
             "selected_game": self.selected_game,
             "old_layout": self.old_layout,
             "cfg_scale": self.cfg_scale,
+            "batched_cfg": self.batched_cfg,
+            "warm_start_t0": self.warm_start_t0,
+            "warm_start_shift": self.warm_start_shift,
+            "solver": self.solver.model_dump() if self.solver is not None else None,
+            "drop_vl_padding": self.drop_vl_padding,
+            "quantization": self.model.quantization,
+            "compiled": self.model.compiled,
             "context_length": self.max_buffer_size,
             "action_interleaving": self.action_interleaving,
             "is_flowmatching": self.is_flowmatching,
             "action_downsample_ratio": self.action_downsample_ratio,
+            "device": str(self.device),
+            "num_threads": torch.get_num_threads(),
+            "latency": self.latency_stats(),
+        }
+
+    def latency_stats(self):
+        """Summary of recent predict latencies in milliseconds."""
+        if len(self.latencies) == 0:
+            return None
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "n": len(latencies),
+            "mean_ms": float(latencies.mean()),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
         }
 
+    def select_game(self, game: str | None):
+        """Condition predictions on `game`, or run unconditionally if None."""
+        if game is not None and (self.game_mapping is None or game not in self.game_mapping):
+            raise ValueError(f"Game '{game}' not found in game mapping")
+        self.selected_game = game
+
     def reset(self):
         """Reset all buffers."""
         self.obs_buffer.clear()
         self.action_buffer.clear()
 
-    def predict(self, obs):
-        start_time = time.time()
+    def _autocast(self):
+        return get_autocast(self.device, enabled=self.model.quantization is None)
+
+    def fork(self):
+        """
+        New session with empty buffers that shares the model, tokenizer, image
+        processor and settings of this one. Forked sessions can be batched
+        together with `predict_batch`.
+        """
+        return type(self)(
+            self.model,
+            self.ckpt_path,
+            self.tokenizer,
+            self.img_proc,
+            self.ckpt_config,
+            self.game_mapping,
+            self.selected_game,
+            self.old_layout,
+            self.cfg_scale,
+            self.action_downsample_ratio,
+            self.max_buffer_size,
+            self.batched_cfg,
+            self.warm_start_t0,
+            self.warm_start_shift,
+            self.solver,
+            self.drop_vl_padding,
+        )
+
+    def warm_up(self, max_batch_size: int = 1):
+        """
+        Predict on blank frames with batches of forked sessions of every size up
+        to `max_batch_size`, filling their frame buffers, so that the shapes of
+        every batch size, CFG branch and number of buffered frames have been
+        run once. With a compiled model, this compiles the graphs, or loads them
+        from the cache, before serving. This session is left untouched.
+        """
+        config = self.img_proc.config
+        frame = np.zeros((config.height, config.width, 3), dtype=np.uint8)
+        for batch_size in range(1, max_batch_size + 1):
+            sessions = [self.fork() for _ in range(batch_size)]
+            for _ in range(self.max_buffer_size):
+                self.predict_batch(sessions, [frame] * batch_size)
+
+    def predict(self, obs, solver: SolverConfig | None = None):
+        """Predict the next action chunk for frame `obs`. `solver` overrides the session's solver."""
+        start_time = time.perf_counter()
+
+        # Only the newest frame goes through the vision encoder, older ones are cached
+        self._encode_frames([self], [obs])
 
-        current_frame = self.img_proc([obs], return_tensors="pt")["pixel_values"]
-        self.obs_buffer.append(current_frame)
-        
         # Prepare model inputs
-        pixel_values = torch.cat(list(self.obs_buffer), dim=0)
-    
-        if self.action_interleaving and len(self.action_buffer) > 0:
-            action_tensors = {
-                key: torch.cat([a[key] for a in list(self.action_buffer)], dim=0)
-                for key in ["buttons", "j_left", "j_right"]
-            }
-        else:
-            action_tensors = {"buttons": None, "j_left": None, "j_right": None}
+        visual_features = self.obs_buffer.window()
+        action_tensors = self._action_history()
 
         print("Running inference with the following inputs:")
-        print(f"- pixel_values: {pixel_values.shape}")
+        print(f"- visual_features: {visual_features.shape} ({len(self.obs_buffer)} frames)")
         print("- action_tensors:")
         for k, v in action_tensors.items():
             if v is not None:
@@ -203,18 +579,85 @@ class InferenceSession:
 
         # Run inference
         if self.is_flowmatching:
-            predicted_actions = self._predict_flowmatching(pixel_values, action_tensors)
+            predicted_actions = self._predict_flowmatching(visual_features, action_tensors, solver)
         else:
-            predicted_actions = self._predict_ar(pixel_values, action_tensors)
+            predicted_actions = self._predict_ar(visual_features, action_tensors)
         
         # Add to action buffer
         self.action_buffer.append(predicted_actions)
         
-        inference_time = time.time() - start_time
-        print(f"Inference time: {inference_time:.3f}s")
+        inference_time = time.perf_counter() - start_time
+        self.latencies.append(inference_time)
+        print(f"Inference time ({self.device.type}): {inference_time:.3f}s")
+
+        return self._to_numpy(predicted_actions)
 
+    @staticmethod
+    def predict_batch(
+        sessions: list["InferenceSession"], observations: list, solver: SolverConfig | None = None,
+    ) -> list[dict]:
+        """
+        Predict one action chunk for each session in a single batched pass.
+
+        The sessions must share the model and settings, e.g. by being forked
+        from the same session. Each session gets the newest frame from
+        `observations` appended to its own buffers, exactly as `predict` does;
+        the frames may have different resolutions. `solver` overrides the
+        sessions' solver.
+        """
+        start_time = time.perf_counter()
+        lead = sessions[0]
+        for session in sessions[1:]:
+            if (
+                session.model is not lead.model
+                or session.cfg_scale != lead.cfg_scale
+                or session.warm_start_t0 != lead.warm_start_t0
+                or session.drop_vl_padding != lead.drop_vl_padding
+                or (solver is None and session.solver != lead.solver)
+            ):
+                raise ValueError("Batched sessions must share the model and settings")
+        if not lead.is_flowmatching:
+            raise ValueError("Batched prediction requires a flow matching model")
+
+        lead._encode_frames(sessions, observations)
+
+        inputs = [session._tokenize(session.obs_buffer.window()) for session in sessions]
+        data_cond = collate_inputs([cond for cond, _ in inputs])
+        data_uncond = collate_inputs([uncond for _, uncond in inputs])
+        # The batch is warm-started only if every session has a previous chunk
+        priors = [session._warm_start_prior() for session in sessions]
+        prior_actions = torch.cat(priors) if all(prior is not None for prior in priors) else None
+        predicted_actions = lead._run_model(data_cond, data_uncond, prior_actions, solver)
+
+        inference_time = time.perf_counter() - start_time
+        results = []
+        for i, session in enumerate(sessions):
+            session_actions = {k: v[i:i + 1] for k, v in predicted_actions.items()}
+            session.action_buffer.append(session_actions)
+            session.latencies.append(inference_time)
+            results.append(session._to_numpy(session_actions))
+        return results
+
+    def _encode_frames(self, sessions, observations):
+        """Encode the newest frame of each session in one vision encoder pass."""
+        current_frames = torch.cat([self.img_proc(obs) for obs in observations])
+        with torch.inference_mode():
+            with self._autocast():
+                frame_features = self.model.encode_images(current_frames[:, None])
+        for session, features in zip(sessions, frame_features):
+            session.obs_buffer.append(features[0])
+
+    def _action_history(self):
+        if self.action_interleaving and len(self.action_buffer) > 0:
+            return {
+                key: torch.cat([a[key] for a in list(self.action_buffer)], dim=0)
+                for key in ["buttons", "j_left", "j_right"]
+            }
+        return {"buttons": None, "j_left": None, "j_right": None}
+
+    @staticmethod
+    def _to_numpy(predicted_actions):
         # Convert to list of action dicts
-        n_actions = len(predicted_actions["buttons"])
         j_left = predicted_actions["j_left"].squeeze().cpu().numpy()
         j_right = predicted_actions["j_right"].squeeze().cpu().numpy()
         buttons = predicted_actions["buttons"].squeeze().cpu().numpy()
@@ -225,52 +668,89 @@ class InferenceSession:
             "buttons": buttons,
         }
 
-    def _predict_flowmatching(self, pixel_values, action_tensors):
+    def _predict_flowmatching(self, visual_features, action_tensors, solver=None):
+        tokenized_data_with_history, tokenized_data_without_history = self._tokenize(visual_features)
+        return self._run_model(tokenized_data_with_history, tokenized_data_without_history, self._warm_start_prior(), solver)
+
+    def _warm_start_prior(self):
+        """Previous action chunk shifted by `warm_start_shift` actions, or None if there is nothing to warm start from."""
+        if self.warm_start_t0 is None or len(self.action_buffer) == 0:
+            return None
+        previous = self.action_buffer[-1]["action_tensor"]
+        shift = self.warm_start_shift
+        if shift >= previous.shape[1]:
+            return None
+        # The tail of the prior repeats the last predicted action
+        return torch.cat([previous[:, shift:], previous[:, -1:].expand(-1, shift, -1)], dim=1)
 
+    def _tokenize(self, visual_features):
+        """
+        Model inputs with and without history for the buffered frames, each with
+        a batch dimension of 1.
+        """
+        # Frames are represented by their cached vision features, so the
+        # tokenizer only needs the dropped-frame masks. Their token layouts are
+        # memoized as device tensors by the tokenizer
         available_frames = len(self.obs_buffer)
-        frames = torch.zeros((self.max_buffer_size, *pixel_values.shape[1:]), 
-                            dtype=pixel_values.dtype, device="cuda")
-        frames[-available_frames:] = pixel_values
-        dropped_frames = torch.zeros((self.max_buffer_size,), dtype=torch.bool, device="cuda")
-        dropped_frames[:self.max_buffer_size - available_frames] = True
-        
-        data_with_history = {
-            "frames": frames,
-            "dropped_frames": dropped_frames,
-            "game": self.selected_game
-        }
-        tokenized_data_with_history = self.tokenizer.encode(data_with_history)
+        dropped_frames = [True] * (self.max_buffer_size - available_frames) + [False] * available_frames
+        tokenized_data_with_history = self.tokenizer.encode_template(dropped_frames, self.selected_game, self.device)
+
+        frame_mask = [True] * (self.max_buffer_size - 1) + [False]
+        tokenized_data_without_history = self.tokenizer.encode_template(frame_mask, None, self.device)
+
+        visual_features = visual_features.unsqueeze(0)
+        tokenized_data_with_history["visual_features"] = visual_features
+        tokenized_data_without_history["visual_features"] = visual_features
+
+        # The layout only depends on the number of frames and the game
+        key = (available_frames, self.selected_game)
+        if key not in self.embedding_indices:
+            self.embedding_indices[key] = [
+                self._embedding_indices(tokenized_data, visual_features.shape[2])
+                for tokenized_data in [tokenized_data_with_history, tokenized_data_without_history]
+            ]
+        for tokenized_data, indices in zip([tokenized_data_with_history, tokenized_data_without_history], self.embedding_indices[key]):
+            tokenized_data.update(indices)
         
-        frame_mask = torch.ones((self.max_buffer_size,), dtype=torch.bool, device="cuda")
-        frame_mask[-1] = False
-        data_without_history = {
-            "frames": frames,
-            "dropped_frames": frame_mask,
-            "game": None
+        return tokenized_data_with_history, tokenized_data_without_history
+
+    def _embedding_indices(self, tokenized_data, tokens_per_frame):
+        """
+        Indices that let the model assemble the VL and state-action embeddings
+        with one indexed copy each, instead of the masked scatters and their
+        host syncs on every step.
+        """
+        return {
+            "vl_embedding_index": NitroGen.vl_embedding_index(
+                tokenized_data["vl_token_ids"], tokenized_data["dropped_images"], tokens_per_frame
+            ),
+            "sa_embedding_index": NitroGen.sa_embedding_index(tokenized_data["sa_token_ids"]),
         }
-        tokenized_data_without_history = self.tokenizer.encode(data_without_history)
-        
-        # Convert to CUDA tensors with batch dimension
-        for tokenized_data in [tokenized_data_with_history, tokenized_data_without_history]:
-            for k, v in tokenized_data.items():
-                if isinstance(v, torch.Tensor):
-                    tokenized_data[k] = v.unsqueeze(0).to("cuda")
-                elif isinstance(v, np.ndarray):
-                    tokenized_data[k] = torch.tensor(v, device="cuda").unsqueeze(0)
-                else:
-                    tokenized_data[k] = [v]
-        
+
+    def _run_model(self, tokenized_data_with_history, tokenized_data_without_history, prior_actions=None, solver=None):
+        solver = solver if solver is not None else self.solver
         with torch.inference_mode():
-            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            with self._autocast():
                 if self.cfg_scale == 1.0:
                     model_output = self.model.get_action(tokenized_data_with_history, 
-                                                        old_layout=self.old_layout)
+                                                        old_layout=self.old_layout,
+                                                        prior_actions=prior_actions,
+                                                        t0=self.warm_start_t0 or 0.0,
+                                                        solver=solver,
+                                                        drop_vl_padding=self.drop_vl_padding)
                 else:
                     model_output = self.model.get_action_with_cfg(
                         tokenized_data_with_history,
                         tokenized_data_without_history,
-                        cfg_scale=self.cfg_scale
+                        cfg_scale=self.cfg_scale,
+                        batched=self.batched_cfg,
+                        prior_actions=prior_actions,
+                        t0=self.warm_start_t0 or 0.0,
+                        solver=solver,
+                        drop_vl_padding=self.drop_vl_padding,
                     )
                 predicted_actions = self.tokenizer.decode(model_output)
+        # Kept in the action buffer to warm start the next prediction
+        predicted_actions["action_tensor"] = model_output["action_tensor"]
         
         return predicted_actions
@@ -64,6 +64,9 @@ _GAME_ID_TOKEN = 6
 
 _UNCONDITIONAL_ID = None  # Special ID for unconditional game
 
+# Model inputs kept in the inference templates of NitrogenTokenizer.encode_template
+_TEMPLATE_KEYS = ["vl_token_ids", "sa_token_ids", "vl_attn_mask", "dropped_images", "embodiment_id", "game_ids"]
+
 class GameMappingConfig(BaseModel):
     src_files: list[str] = Field(default_factory=list, description="List of source parquet files to build game mapping.")
 
@@ -116,11 +119,16 @@ class NitrogenTokenizer(Tokenizer):
         else:
             self.game_mapping = None
 
+        # Inference templates, see `encode_template`
+        self.templates = {}
+
     def train(self):
         self.training = True
+        self.templates.clear()
 
     def eval(self):
         self.training = False
+        self.templates.clear()
 
     def check_batch_size(self, data):
         # Use video key to determine batch size.
@@ -322,6 +330,28 @@ class NitrogenTokenizer(Tokenizer):
             transformed_data["game_ids"] = torch.tensor(0, dtype=torch.long)
         return transformed_data
 
+    def encode_template(self, dropped_frames, game: str | None, device) -> dict:
+        """
+        Inference inputs for a frame layout and a game: the model inputs `encode`
+        returns when there are no actions, as tensors on `device` with a batch
+        dimension of 1.
+
+        At inference the token layout only depends on which frames are dropped
+        and on the game, so templates are memoized per (dropped_frames, game,
+        device) and the per-frame path does no Python or numpy work. The returned
+        dict is new, but its tensors are the cached ones and must not be
+        modified in place. The cache is cleared by `train()` and `eval()`.
+        """
+        if self.training:
+            raise RuntimeError("Tokenizer templates are only available in inference mode")
+        key = (tuple(bool(dropped) for dropped in dropped_frames), game, str(device))
+        template = self.templates.get(key)
+        if template is None:
+            tokenized = self.encode({"frames": None, "dropped_frames": np.array(key[0]), "game": game})
+            template = {k: torch.as_tensor(tokenized[k]).unsqueeze(0).to(device) for k in _TEMPLATE_KEYS}
+            self.templates[key] = template
+        return dict(template)
+
     def decode(self, data: dict) -> dict:
         j_left, j_right, buttons = self.unpack_actions(data["action_tensor"])
         
@@ -0,0 +1,189 @@
+"""
+Binary wire protocol shared by ModelClient and InferenceServer.
+
+A message is a multipart ZMQ message: a small JSON header frame followed by
+one raw frame per array. The header lists the arrays in frame order with
+their name, dtype and shape, next to the request or response fields, e.g.
+
+    {"type": "predict", "session": "...", "seq": 12,
+     "arrays": [{"name": "image", "dtype": "|u1", "shape": [256, 256, 3]}]}
+    <256 * 256 * 3 bytes>
+
+Arrays are sent with `copy=False` and read back with `np.frombuffer` on the
+received frames, so frames and action chunks are neither pickled nor copied
+by the protocol. Nothing in a message is executed or unpickled. The arrays
+read back are read-only views, with both transports: copy them to modify
+them.
+
+When client and server run on the same host, arrays can instead be passed
+through a `SharedMemoryRing`. The message then only carries the slot index
+and the array specs, with their byte offsets in the slot, under
+`shm_arrays`.
+"""
+import os
+import sys
+import json
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import zmq
+
+# Array dtypes accepted from the wire
+_ALLOWED_DTYPE_KINDS = "biuf"
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def default_ipc_path(port: int) -> str:
+    """Path of the ipc endpoint the server binds next to its tcp port."""
+    return os.path.join("/tmp", f"nitrogen-{port}.ipc")
+
+
+def _array_spec(name: str, array: np.ndarray) -> dict:
+    return {"name": name, "dtype": array.dtype.str, "shape": list(array.shape)}
+
+
+def _check_spec(spec) -> dict:
+    if not isinstance(spec, dict):
+        raise ProtocolError(f"Invalid array spec {spec!r}")
+    if not isinstance(spec.get("name"), str) or not isinstance(spec.get("dtype"), str) or not isinstance(spec.get("shape"), list):
+        raise ProtocolError(f"Array spec needs a str name and dtype and a list shape, got {spec!r}")
+    return spec
+
+
+def _frombuffer(buffer, spec: dict, offset: int = 0) -> np.ndarray:
+    _check_spec(spec)
+    try:
+        dtype = np.dtype(spec["dtype"])
+        if dtype.kind not in _ALLOWED_DTYPE_KINDS:
+            raise ProtocolError(f"Unsupported dtype {dtype}")
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(spec["shape"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ProtocolError(f"Invalid array {spec['name']}: {e}") from e
+
+
+def pack(header: dict, arrays: dict[str, np.ndarray] | None = None) -> list:
+    """Build the frames of a message. Send them with `send_multipart(frames, copy=False)`."""
+    arrays = {} if arrays is None else {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    header = {
+        **header,
+        "arrays": [_array_spec(name, a) for name, a in arrays.items()],
+    }
+    return [json.dumps(header).encode()] + list(arrays.values())
+
+
+def _buffer(frame):
+    return frame.buffer if isinstance(frame, zmq.Frame) else frame
+
+
+def unpack(frames: list) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Parse the frames of a message, as returned by `recv_multipart(copy=False)`
+    or `recv_multipart()`. Arrays are read-only views of the received frames.
+    """
+    if len(frames) == 0:
+        raise ProtocolError("Empty message")
+    try:
+        header = json.loads(bytes(_buffer(frames[0])))
+    except (ValueError, TypeError) as e:
+        raise ProtocolError(f"Invalid message header: {e}") from e
+    if not isinstance(header, dict):
+        raise ProtocolError("Message header is not an object")
+    specs = header.pop("arrays", None)
+    if not isinstance(specs, list):
+        raise ProtocolError("Message header has no list of arrays")
+    if len(specs) != len(frames) - 1:
+        raise ProtocolError(f"Header lists {len(specs)} arrays but the message has {len(frames) - 1}")
+
+    arrays = {}
+    for spec, frame in zip(specs, frames[1:]):
+        buffer = _buffer(frame)
+        array = _frombuffer(buffer, spec)
+        if array.nbytes != len(buffer):
+            raise ProtocolError(f"Invalid array {spec['name']}: frame size does not match its shape")
+        arrays[spec["name"]] = array
+    return header, arrays
+
+
+class SharedMemoryRing:
+    """
+    Ring of fixed-size slots in a `multiprocessing.shared_memory` block.
+
+    The process that creates the ring owns the block and unlinks it on close.
+    The peer attaches to it by name with `SharedMemoryRing.attach(ring.spec())`.
+    Arrays are written into a slot at aligned offsets, and read back as
+    read-only numpy views of the block, without copies.
+    """
+
+    ALIGNMENT = 64
+
+    def __init__(self, num_slots: int, slot_bytes: int, name: str | None = None):
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=num_slots * slot_bytes)
+        elif sys.version_info >= (3, 13):
+            self.shm = SharedMemory(name=name, track=False)
+        else:
+            self.shm = SharedMemory(name=name)
+            if os.name == "posix":
+                # Attaching registers the block with this process' resource tracker,
+                # which would unlink it from under its owner when this process exits
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        if self.shm.size < num_slots * slot_bytes:
+            self.close()
+            raise ProtocolError(f"Shared memory block {name} is smaller than {num_slots} slots of {slot_bytes} bytes")
+        self.next_slot = 0
+
+    @classmethod
+    def attach(cls, spec: dict) -> "SharedMemoryRing":
+        try:
+            return cls(int(spec["num_slots"]), int(spec["slot_bytes"]), name=str(spec["name"]))
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            raise ProtocolError(f"Cannot attach to shared memory ring: {e}") from e
+
+    def spec(self) -> dict:
+        return {"name": self.shm.name, "num_slots": self.num_slots, "slot_bytes": self.slot_bytes}
+
+    def acquire(self) -> int:
+        """Index of the next slot to write, in round-robin order."""
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % self.num_slots
+        return slot
+
+    def fits(self, arrays: dict[str, np.ndarray]) -> bool:
+        size = 0
+        for array in arrays.values():
+            size += -size % self.ALIGNMENT + array.nbytes
+        return size <= self.slot_bytes
+
+    def write(self, slot: int, arrays: dict[str, np.ndarray]) -> list[dict]:
+        """Copy arrays into a slot and return their specs, with offsets relative to the slot."""
+        specs, offset = [], 0
+        for name, array in arrays.items():
+            offset += -offset % self.ALIGNMENT
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes + offset)
+            view[...] = array
+            specs.append({**_array_spec(name, array), "offset": offset})
+            offset += array.nbytes
+        return specs
+
+    def read(self, slot: int, specs: list[dict]) -> dict[str, np.ndarray]:
+        """Read-only views of the arrays written into a slot."""
+        if not isinstance(slot, int) or not 0 <= slot < self.num_slots:
+            raise ProtocolError(f"Invalid slot {slot}")
+        slot_buffer = self.shm.buf[slot * self.slot_bytes:(slot + 1) * self.slot_bytes].toreadonly()
+        try:
+            return {spec["name"]: _frombuffer(slot_buffer, spec, offset=int(spec.get("offset", 0))) for spec in specs}
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            raise ProtocolError(f"Invalid shared memory arrays: {e}") from e
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,98 @@
+"""
+CPU micro-benchmark for NitroGen.get_action on a tiny configuration.
+
+Compares the sampler against the previous loop, which rebuilt the
+vision-language context and re-ran the VL self-attention on every
+denoising step, and checks that both produce the same actions. With
+`--cfg`, also compares batched and sequential get_action_with_cfg.
+
+    python scripts/bench_get_action.py --steps 16 --ctx 1 --cfg
+"""
+import argparse
+
+import torch
+
+from bench_utils import tiny_model, tiny_tokenizer, make_inputs, timeit, format_times
+
+
+@torch.inference_mode()
+def get_action_per_step_context(model, data):
+    """Reference sampler that rebuilds the VL context on every step."""
+    embodiment_id = data["embodiment_id"]
+    actions = torch.randn(
+        size=(data["images"].shape[0], model.action_horizon, model.action_dim),
+        dtype=data["images"].dtype,
+        device=data["images"].device,
+    )
+    num_steps = model.num_inference_timesteps
+    dt = 1.0 / num_steps
+    visual_features = model.encode_images(data["images"])
+    for i in range(num_steps):
+        t_discretized = int(i / float(num_steps) * model.num_timestep_buckets)
+        action_features = model.action_encoder(
+            actions,
+            torch.full((actions.shape[0],), float(t_discretized)),
+            embodiment_id,
+        )
+        vl_embs, sa_embs = model.prepare_input_embs(
+            data["vl_token_ids"],
+            data["sa_token_ids"],
+            visual_features,
+            action_features,
+            data["dropped_images"],
+            game_ids=data["game_ids"],
+        )
+        vl_embs = model.vl_self_attention_model(vl_embs)
+        model_output = model.model(
+            hidden_states=sa_embs,
+            encoder_hidden_states=vl_embs,
+            timestep=torch.tensor([t_discretized]),
+        )
+        pred = model.action_decoder(model_output, embodiment_id)
+        actions = actions + dt * pred[:, -actions.shape[1]:]
+    return {"action_tensor": actions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="get_action micro-benchmark")
+    parser.add_argument("--steps", type=int, default=16, help="Number of denoising steps")
+    parser.add_argument("--ctx", type=int, default=1, help="Context length")
+    parser.add_argument("--iters", type=int, default=20, help="Timed iterations")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads")
+    parser.add_argument("--cfg", action="store_true", help="Also benchmark get_action_with_cfg")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model = tiny_model(num_inference_timesteps=args.steps)
+    tokenizer = tiny_tokenizer(model, context_length=args.ctx)
+    data, data_uncond = make_inputs(model, tokenizer, context_length=args.ctx)
+
+    torch.manual_seed(0)
+    reference = get_action_per_step_context(model, data)["action_tensor"]
+    torch.manual_seed(0)
+    actions = model.get_action(data)["action_tensor"]
+    print(f"max |delta| vs per-step context: {(actions - reference).abs().max().item():.3e}")
+
+    baseline = timeit(lambda: get_action_per_step_context(model, data), iters=args.iters)
+    hoisted = timeit(lambda: model.get_action(data), iters=args.iters)
+    print(format_times("per-step VL context", baseline))
+    print(format_times("hoisted VL context", hoisted))
+    print(f"saving per prediction: {baseline.mean() - hoisted.mean():.2f} ms ({baseline.mean() / hoisted.mean():.2f}x)")
+
+    if args.cfg:
+        torch.manual_seed(0)
+        sequential_actions = model.get_action_with_cfg(data, data_uncond, cfg_scale=2.0, batched=False)["action_tensor"]
+        torch.manual_seed(0)
+        batched_actions = model.get_action_with_cfg(data, data_uncond, cfg_scale=2.0, batched=True)["action_tensor"]
+        print(f"max |delta| batched vs sequential CFG: {(batched_actions - sequential_actions).abs().max().item():.3e}")
+
+        sequential = timeit(lambda: model.get_action_with_cfg(data, data_uncond, cfg_scale=2.0, batched=False), iters=args.iters)
+        batched = timeit(lambda: model.get_action_with_cfg(data, data_uncond, cfg_scale=2.0, batched=True), iters=args.iters)
+        print(format_times("sequential CFG", sequential))
+        print(format_times("batched CFG", batched))
+
+
+if __name__ == "__main__":
+    main()
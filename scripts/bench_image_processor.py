@@ -0,0 +1,54 @@
+"""
+Check ImageProcessor against the HF image processor it replaces, and time both.
+
+Random noise, the worst case for resampling, and smooth frames are
+preprocessed at sizes below, at and above the target size, i.e. upscaled,
+unchanged and downscaled. For each size it reports the max and mean deviation
+from the HF processor in uint8 levels, and the latency of both.
+
+    python scripts/bench_image_processor.py
+    python scripts/bench_image_processor.py --sizes 100x120 720x1280 --resample bilinear
+"""
+import argparse
+
+import numpy as np
+from PIL import Image
+from transformers import SiglipImageProcessor
+
+from nitrogen.image_processor import ImageProcessor, ImageProcessorConfig
+from bench_utils import timeit
+
+_PIL_FILTERS = {"nearest": Image.NEAREST, "bilinear": Image.BILINEAR, "bicubic": Image.BICUBIC}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Image preprocessing check")
+    parser.add_argument("--sizes", type=str, nargs="+", default=["64x64", "100x120", "180x320", "256x256", "300x200", "720x1280"], help="Frame sizes as HxW")
+    parser.add_argument("--target", type=int, default=256, help="Target size")
+    parser.add_argument("--resample", type=str, choices=list(_PIL_FILTERS), default="bicubic", help="Resampling filter")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random frames")
+    args = parser.parse_args()
+
+    hf_processor = SiglipImageProcessor(size={"height": args.target, "width": args.target}, resample=_PIL_FILTERS[args.resample])
+    processor = ImageProcessor(ImageProcessorConfig.from_hf(hf_processor))
+    level = processor.lut[0, 1] - processor.lut[0, 0]
+
+    rng = np.random.default_rng(args.seed)
+    print(f"target {args.target}x{args.target}, {args.resample}, deviation in uint8 levels")
+    print(f"{'size':<10} {'frame':<8} {'max':>6} {'mean':>8} {'HF ms':>8} {'torch ms':>9}")
+    for size in args.sizes:
+        height, width = map(int, size.split("x"))
+        noise = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        smooth = np.asarray(
+            Image.fromarray(noise).resize((max(width // 8, 2), max(height // 8, 2))).resize((width, height), Image.BILINEAR)
+        )
+        for name, frame in [("noise", noise), ("smooth", smooth)]:
+            reference = hf_processor([Image.fromarray(frame)], return_tensors="pt")["pixel_values"]
+            deviation = ((processor(frame) - reference).abs() / level).round()
+            hf_ms = np.median(timeit(lambda: hf_processor([frame], return_tensors="pt"), warmup=1, iters=5))
+            torch_ms = np.median(timeit(lambda: processor(frame), warmup=1, iters=5))
+            print(f"{size:<10} {name:<8} {deviation.max().item():>6.0f} {deviation.mean().item():>8.4f} {hf_ms:>8.2f} {torch_ms:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Report model startup time and memory for one or more checkpoint formats.
+
+Each checkpoint is loaded with load_model in a fresh process, which reports
+the wall time, its resident memory after loading (split into anonymous memory
+and file-backed pages that other processes can share through the page cache),
+and its peak resident memory. Linux only, as it reads /proc/self/status.
+
+    python scripts/convert_ckpt.py ng.pt ng.safetensors --format safetensors
+    python scripts/bench_load.py ng.pt ng.safetensors --device cpu
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+def read_memory_mb():
+    fields = {}
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "RssAnon", "RssFile"):
+                fields[key] = int(value.split()[0]) / 1024
+    return fields
+
+
+def measure(checkpoint_path, device):
+    """Load the checkpoint in this process and print the measurements as JSON."""
+    import torch
+    from nitrogen.inference_session import load_model
+
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull  # load_model prints the config and model summary
+        start = time.perf_counter()
+        model = load_model(checkpoint_path, device=device)[0]
+        if device is not None and device.startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        sys.stdout = stdout
+
+    memory = read_memory_mb()
+    print(json.dumps({"load_s": elapsed, **memory}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checkpoint startup benchmark")
+    parser.add_argument("ckpts", type=str, nargs="+", help="Checkpoints to load (.pt or .safetensors)")
+    parser.add_argument("--device", type=str, default="cpu", help="Device to load the model on")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.ckpts[0], args.device)
+        exit(0)
+
+    print(f"{'checkpoint':<40} {'load':>8} {'RSS':>10} {'anon':>10} {'file':>10} {'peak RSS':>10}")
+    for ckpt in args.ckpts:
+        output = subprocess.run(
+            [sys.executable, __file__, ckpt, "--device", args.device, "--child"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{os.path.basename(ckpt):<40} {result['load_s']:>7.2f}s "
+            f"{result['VmRSS']:>8.0f}MB {result['RssAnon']:>8.0f}MB {result['RssFile']:>8.0f}MB {result['VmHWM']:>8.0f}MB"
+        )
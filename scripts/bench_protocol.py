@@ -0,0 +1,145 @@
+"""
+Benchmark the round trip of a predict request between ModelClient and the
+inference server for each transport, against the previous pickle protocol.
+
+The server runs in a separate process and answers every predict request with
+a fixed action chunk, so only serialization and transport are measured:
+- pickle: the previous REQ client and REP server loop, over tcp.
+- binary: ModelClient and InferenceServer with the binary protocol, over tcp.
+- shm: ModelClient and InferenceServer over ipc, with frames and action
+  chunks passed through shared memory rings.
+
+    python scripts/bench_protocol.py
+    python scripts/bench_protocol.py --sizes 256x256 2560x1440 --iters 200
+"""
+import os
+import sys
+import time
+import pickle
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import zmq
+
+from nitrogen.inference_client import ModelClient
+from nitrogen.inference_server import InferenceServer
+from bench_utils import format_times, timeit
+
+ACTION_HORIZON = 16
+NUM_BUTTONS = 21
+
+
+def action_chunk():
+    return {
+        "j_left": np.zeros((ACTION_HORIZON, 2), dtype=np.float32),
+        "j_right": np.zeros((ACTION_HORIZON, 2), dtype=np.float32),
+        "buttons": np.zeros((ACTION_HORIZON, NUM_BUTTONS), dtype=np.float32),
+    }
+
+
+class EchoSession:
+    def fork(self):
+        return self
+
+    def reset(self):
+        pass
+
+    def info(self):
+        return {}
+
+
+class EchoServer(InferenceServer):
+    """InferenceServer that answers every predict request with the same action chunk."""
+
+    def predict_batch(self, sessions, images, solver=None):
+        return [action_chunk() for _ in images]
+
+
+def pickle_server(port, ipc_path):
+    context = zmq.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind(f"tcp://*:{port}")
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    pred = action_chunk()
+    while True:
+        events = dict(poller.poll(timeout=100))
+        if socket in events and events[socket] == zmq.POLLIN:
+            request = pickle.loads(socket.recv())
+            image = np.asarray(request["image"])
+            socket.send(pickle.dumps({"status": "ok", "pred": pred}))
+
+
+def echo_server(port, ipc_path):
+    sys.stdout = open(os.devnull, "w")
+    EchoServer(EchoSession(), port=port, batch_timeout_ms=0, ipc_path=ipc_path).serve_forever()
+
+
+SERVERS = {"pickle": pickle_server, "echo": echo_server}
+
+
+def bench_pickle(port, ipc_path, image, warmup, iters):
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect(f"tcp://localhost:{port}")
+
+    def predict():
+        socket.send(pickle.dumps({"type": "predict", "image": image}))
+        return pickle.loads(socket.recv())["pred"]
+
+    times = timeit(predict, warmup=warmup, iters=iters)
+    socket.close()
+    context.term()
+    return times
+
+
+def bench_client(transport):
+    def bench(port, ipc_path, image, warmup, iters):
+        client = ModelClient(port=port, transport=transport, ipc_path=ipc_path)
+        times = timeit(lambda: client.predict(image), warmup=warmup, iters=iters)
+        client.close()
+        return times
+    return bench
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wire protocol round-trip benchmark")
+    parser.add_argument("--sizes", type=str, nargs="+", default=["256x256", "2560x1440"], help="Frame sizes as WIDTHxHEIGHT")
+    parser.add_argument("--port", type=int, default=5560, help="Port of the benchmark servers")
+    parser.add_argument("--warmup", type=int, default=10, help="Warmup iterations")
+    parser.add_argument("--iters", type=int, default=100, help="Timed iterations")
+    parser.add_argument("--server", type=str, choices=list(SERVERS), default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--ipc-path", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.server is not None:
+        SERVERS[args.server](args.port, args.ipc_path)
+
+    ipc_path = os.path.join(tempfile.gettempdir(), f"nitrogen-bench-{args.port}.ipc")
+    transports = [
+        ("pickle", "pickle", bench_pickle),
+        ("binary", "echo", bench_client("tcp")),
+        ("shm", "echo", bench_client("shm")),
+    ]
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        width, height = (int(x) for x in size.split("x"))
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        print(f"\nFrame {width}x{height} ({image.nbytes / 1e6:.2f} MB)")
+
+        results = {}
+        for name, server, bench in transports:
+            # A separate interpreter, like a real server, with its own shared memory tracking
+            process = subprocess.Popen([
+                sys.executable, __file__, "--server", server, "--port", str(args.port), "--ipc-path", ipc_path,
+            ])
+            time.sleep(2)
+            results[name] = bench(args.port, ipc_path, image, args.warmup, args.iters)
+            process.terminate()
+            process.wait()
+            print(format_times(name, results[name]))
+        for name in ["binary", "shm"]:
+            print(f"{name} speedup over pickle (p50): {np.median(results['pickle']) / np.median(results[name]):.2f}x")
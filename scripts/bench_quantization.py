@@ -0,0 +1,98 @@
+"""
+Accuracy and latency of int8 quantized CPU inference against fp32.
+
+Sessions sharing the frames and the sampling noise predict every frame:
+- fp32: the unquantized model without autocast, the reference.
+- bf16: the unquantized model under bf16 autocast, as served by default on
+  CPUs that support it. Its deviation is a floor for the one of int8.
+- int8: a copy of the model quantized with quantize_model.
+
+For each session it reports the latency, the max and mean absolute error of
+the action tensor, i.e. of the normalized actions before decoding, and the mean
+absolute joystick error and fraction of matching buttons after decoding.
+
+Frames are read from `--video` (a recorded gameplay video), otherwise a
+synthetic scene with a moving square is used. Without a checkpoint, a tiny
+model with random weights is used, which only exercises the code path.
+
+    python scripts/bench_quantization.py ng.safetensors --video gameplay.mp4 --cfg 2
+    python scripts/bench_quantization.py --frames 5
+"""
+import io
+import copy
+import time
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+from nitrogen.inference_session import InferenceSession, cpu_supports_bf16, get_autocast, quantize_model
+from bench_utils import tiny_session
+from bench_warm_start import synthetic_frames, video_frames, deviation
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8 quantization benchmark")
+    parser.add_argument("ckpt", type=str, nargs="?", default=None, help="Checkpoint (default: tiny random model)")
+    parser.add_argument("--video", type=str, default=None, help="Video to read frames from (default: synthetic frames)")
+    parser.add_argument("--frames", type=int, default=20, help="Number of predictions")
+    parser.add_argument("--quantization", type=str, default="int8", help="Quantization to compare")
+    parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
+    parser.add_argument("--ctx", type=int, default=1, help="Context length")
+    parser.add_argument("--num-threads", type=int, default=None, help="Number of intra-op CPU threads")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling noise")
+    args = parser.parse_args()
+
+    if args.ckpt is not None:
+        reference = InferenceSession.from_ckpt(
+            args.ckpt, cfg_scale=args.cfg, context_length=args.ctx, device="cpu", num_threads=args.num_threads
+        )
+    else:
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reference = tiny_session(context_length=args.ctx, cfg_scale=args.cfg)
+
+    sessions = {"fp32": reference}
+    reference._autocast = lambda: get_autocast(reference.device, enabled=False)
+    if cpu_supports_bf16():
+        sessions["bf16"] = reference.fork()
+    quantized = reference.fork()
+    quantized.model = quantize_model(copy.deepcopy(reference.model), args.quantization)
+    sessions[args.quantization] = quantized
+
+    if args.video is not None:
+        frames = video_frames(args.video, args.frames, reference.action_downsample_ratio)
+    else:
+        frames = synthetic_frames(args.frames)
+
+    stats = {name: {"latency_ms": [], "max_error": [], "mean_error": [], "joystick_mae": [], "button_match": []} for name in sessions}
+    for i, frame in enumerate(frames):
+        preds, actions = {}, {}
+        for name, session in sessions.items():
+            torch.manual_seed(args.seed + i)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                preds[name] = session.predict(frame)
+            stats[name]["latency_ms"].append((time.perf_counter() - start) * 1000)
+            actions[name] = session.action_buffer[-1]["action_tensor"].float().cpu().numpy()
+        for name in sessions:
+            error = np.abs(actions[name] - actions["fp32"])
+            mae, match = deviation(preds[name], preds["fp32"])
+            stats[name]["max_error"].append(float(error.max()))
+            stats[name]["mean_error"].append(float(error.mean()))
+            stats[name]["joystick_mae"].append(mae)
+            stats[name]["button_match"].append(match)
+
+    print(f"{len(stats['fp32']['latency_ms'])} predictions, cfg {args.cfg}, {torch.get_num_threads()} threads, reference fp32")
+    print(f"{'':<8} {'p50 ms':>10} {'max error':>10} {'mean error':>11} {'joystick MAE':>14} {'buttons match':>14}")
+    for name, s in stats.items():
+        print(
+            f"{name:<8} {np.median(s['latency_ms']):>10.2f} {np.max(s['max_error']):>10.4f} {np.mean(s['mean_error']):>11.4f} "
+            f"{np.mean(s['joystick_mae']):>14.4f} {np.mean(s['button_match']):>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
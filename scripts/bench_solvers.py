@@ -0,0 +1,100 @@
+"""
+Speed/quality trade-off of the ODE solvers of the action head.
+
+Every solver predicts a chunk for the same frames from the same sampling noise,
+and its chunk is compared to the one of a reference solver, by default Euler
+with 100 steps, a close approximation of the exact flow. For each solver it
+reports the number of DiT calls per prediction, the latency and the deviation
+from the reference: max and mean absolute error of the action tensor, i.e. of
+the normalized actions before decoding.
+
+Solvers are given as `method:steps` or `method:steps:time_power`. Without a
+checkpoint, a tiny model with random weights is used, which only exercises the
+code path and timings.
+
+    python scripts/bench_solvers.py ng.safetensors --solvers euler:16 euler:8 heun:4 midpoint:4 euler:8:2
+    python scripts/bench_solvers.py --frames 5
+"""
+import io
+import time
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+from nitrogen.inference_session import InferenceSession
+from nitrogen.flow_matching_transformer.solvers import SolverConfig
+from bench_utils import tiny_session
+from bench_warm_start import synthetic_frames, video_frames
+
+
+def parse_solver(spec: str) -> SolverConfig:
+    method, num_steps, *time_power = spec.split(":")
+    return SolverConfig(method=method, num_steps=int(num_steps), time_power=float(time_power[0]) if time_power else 1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ODE solver benchmark")
+    parser.add_argument("ckpt", type=str, nargs="?", default=None, help="Checkpoint (default: tiny random model)")
+    parser.add_argument("--video", type=str, default=None, help="Video to read frames from (default: synthetic frames)")
+    parser.add_argument("--frames", type=int, default=10, help="Number of predictions per solver")
+    parser.add_argument(
+        "--solvers", type=str, nargs="+",
+        default=["euler:16", "euler:8", "euler:4", "heun:8", "heun:4", "heun:2", "midpoint:8", "midpoint:4", "midpoint:2", "euler:8:2"],
+        help="Solvers to compare, as method:steps[:time_power]",
+    )
+    parser.add_argument("--reference", type=str, default="euler:100", help="Reference solver")
+    parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
+    parser.add_argument("--ctx", type=int, default=1, help="Context length")
+    parser.add_argument("--device", type=str, default=None, help="Device to run inference on")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling noise")
+    args = parser.parse_args()
+
+    if args.ckpt is not None:
+        session = InferenceSession.from_ckpt(args.ckpt, cfg_scale=args.cfg, context_length=args.ctx, device=args.device)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            session = tiny_session(context_length=args.ctx, cfg_scale=args.cfg)
+
+    # Count DiT calls through the shared model
+    dit_calls = [0]
+    dit_forward = session.model.model.forward
+
+    def counted_forward(*f_args, **f_kwargs):
+        dit_calls[0] += 1
+        return dit_forward(*f_args, **f_kwargs)
+    session.model.model.forward = counted_forward
+
+    if args.video is not None:
+        frames = list(video_frames(args.video, args.frames, session.action_downsample_ratio))
+    else:
+        frames = list(synthetic_frames(args.frames))
+
+    def run(solver):
+        """Action tensors, DiT calls and latencies of `solver` on the frames, from the same noise."""
+        forked = session.fork()
+        forked.solver = solver
+        torch.manual_seed(args.seed)
+        actions, calls, latencies = [], [], []
+        for frame in frames:
+            dit_calls[0] = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                forked.predict(frame)
+            latencies.append((time.perf_counter() - start) * 1000)
+            calls.append(dit_calls[0])
+            actions.append(forked.action_buffer[-1]["action_tensor"].float().cpu().numpy())
+        return np.stack(actions), calls, latencies
+
+    reference, *_ = run(parse_solver(args.reference))
+    print(f"{len(frames)} predictions per solver, cfg {args.cfg}, reference {args.reference}")
+    print(f"{'':<16} {'DiT calls':>10} {'p50 ms':>10} {'max error':>10} {'mean error':>11}")
+    for spec in args.solvers:
+        actions, calls, latencies = run(parse_solver(spec))
+        error = np.abs(actions - reference)
+        print(f"{spec:<16} {np.mean(calls):>10.1f} {np.median(latencies):>10.2f} {error.max():>10.4f} {error.mean():>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
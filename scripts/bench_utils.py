@@ -0,0 +1,155 @@
+"""
+Helpers shared by the benchmark scripts: a tiny NitroGen configuration that
+runs on CPU in milliseconds, tokenized inputs built the same way as
+InferenceSession, an InferenceSession around the tiny model, and a small
+timing utility.
+"""
+import time
+
+import numpy as np
+import torch
+from transformers import SiglipVisionConfig
+
+from nitrogen.cfg import CkptConfig, ModalityConfig
+from nitrogen.flow_matching_transformer.nitrogen import NitroGen, NitroGen_Config
+from nitrogen.flow_matching_transformer.modules import DiTConfig, SelfAttentionTransformerConfig
+from nitrogen.image_processor import ImageProcessor, ImageProcessorConfig
+from nitrogen.inference_session import InferenceSession
+from nitrogen.mm_tokenizers import NitrogenTokenizer, NitrogenTokenizerConfig
+
+TINY_GAME_MAPPING = {None: 0, "tiny_game": 1}
+
+
+def tiny_siglip_config(hidden_size=128, num_layers=12, image_size=64, patch_size=4):
+    """
+    Architecture config of a small SigLIP tower, built offline with random weights.
+    NitroGen freezes encoder layer 11, so the tower keeps 12 layers.
+    """
+    config = SiglipVisionConfig(
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=hidden_size // 32,
+        image_size=image_size,
+        patch_size=patch_size,
+    )
+    return config.to_dict()
+
+
+def tiny_model_config(hidden_size=128, num_dit_layers=4, num_vl_layers=2, num_inference_timesteps=16):
+    num_heads = hidden_size // 32
+    return NitroGen_Config(
+        diffusion_model_cfg=DiTConfig(
+            num_attention_heads=num_heads,
+            attention_head_dim=32,
+            output_dim=hidden_size,
+            num_layers=num_dit_layers,
+            cross_attention_dim=hidden_size,
+        ),
+        vl_self_attention_cfg=SelfAttentionTransformerConfig(
+            num_attention_heads=num_heads,
+            attention_head_dim=32,
+            num_layers=num_vl_layers,
+            max_num_positional_embeddings=2048,
+        ),
+        hidden_size=hidden_size,
+        vision_hidden_size=hidden_size,
+        action_dim=25,
+        action_horizon=16,
+        num_inference_timesteps=num_inference_timesteps,
+        vision_encoder_name="tiny-siglip",
+        vision_encoder_cfg=tiny_siglip_config(hidden_size=hidden_size),
+    )
+
+
+def tiny_model(seed=0, **kwargs):
+    torch.manual_seed(seed)
+    model = NitroGen(config=tiny_model_config(**kwargs), game_mapping=TINY_GAME_MAPPING)
+    return model.eval()
+
+
+def tiny_tokenizer_config(model, context_length=1):
+    num_visual_tokens = model.vision_encoder.embeddings.num_patches
+    return NitrogenTokenizerConfig(
+        training=False,
+        num_visual_tokens_per_frame=num_visual_tokens,
+        max_sequence_length=1 + num_visual_tokens * context_length,
+        action_horizon=model.action_horizon,
+    )
+
+
+def tiny_tokenizer(model, context_length=1):
+    tokenizer = NitrogenTokenizer(tiny_tokenizer_config(model, context_length))
+    tokenizer.game_mapping = TINY_GAME_MAPPING
+    return tokenizer
+
+
+def tiny_session(context_length=1, cfg_scale=1.0, seed=0, num_inference_timesteps=16, **session_kwargs):
+    """InferenceSession around a tiny model with random weights, conditioned on the tiny game."""
+    model = tiny_model(seed=seed, num_inference_timesteps=num_inference_timesteps)
+    image_size = model.vision_encoder.config.image_size
+    ckpt_config = CkptConfig(
+        experiment_name="tiny",
+        model_cfg=model.config,
+        tokenizer_cfg=tiny_tokenizer_config(model, context_length),
+        modality_cfg=ModalityConfig(frame_per_sample=context_length),
+        image_processor_cfg=ImageProcessorConfig(height=image_size, width=image_size),
+    )
+    return InferenceSession(
+        model,
+        "tiny",
+        tiny_tokenizer(model, context_length),
+        ImageProcessor(ckpt_config.image_processor_cfg),
+        ckpt_config,
+        TINY_GAME_MAPPING,
+        "tiny_game",
+        old_layout=False,
+        cfg_scale=cfg_scale,
+        action_downsample_ratio=1,
+        context_length=context_length,
+        **session_kwargs,
+    )
+
+
+def make_inputs(model, tokenizer, context_length=1, available_frames=None, game="tiny_game", seed=0, device="cpu"):
+    """Build (cond, uncond) model inputs the way InferenceSession._predict_flowmatching does."""
+    if available_frames is None:
+        available_frames = context_length
+    image_size = model.vision_encoder.config.image_size
+    generator = torch.Generator().manual_seed(seed)
+    frames = torch.zeros((context_length, 3, image_size, image_size))
+    frames[-available_frames:] = torch.randn((available_frames, 3, image_size, image_size), generator=generator)
+
+    dropped_frames = torch.zeros((context_length,), dtype=torch.bool)
+    dropped_frames[:context_length - available_frames] = True
+    frame_mask = torch.ones((context_length,), dtype=torch.bool)
+    frame_mask[-1] = False
+
+    inputs = []
+    for dropped, game_name in [(dropped_frames, game), (frame_mask, None)]:
+        tokenized = tokenizer.encode({"frames": frames, "dropped_frames": dropped, "game": game_name})
+        for k, v in tokenized.items():
+            if isinstance(v, torch.Tensor):
+                tokenized[k] = v.unsqueeze(0).to(device)
+            elif isinstance(v, np.ndarray):
+                tokenized[k] = torch.tensor(v, device=device).unsqueeze(0)
+            else:
+                tokenized[k] = [v]
+        inputs.append(tokenized)
+    return inputs
+
+
+def timeit(fn, warmup=3, iters=20):
+    """Return per-call latencies in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def format_times(name, times):
+    return f"{name:<32} mean {times.mean():8.2f} ms | p50 {np.median(times):8.2f} ms | p95 {np.percentile(times, 95):8.2f} ms"
@@ -0,0 +1,84 @@
+"""
+Cost of the padding of the vision-language sequence, and what dropping it saves.
+
+The tokenizer left-pads the VL tokens to `max_sequence_length`, and the model
+attends to the padding in VL mixing and cross-attention. A session with fewer
+frames than its context length, e.g. right after a reset, or the unconditional
+CFG branch, pads more. Two sessions sharing one model predict on the same
+frames from the same noise, one attending to the padding and one dropping it
+(`drop_vl_padding`). For each number of buffered frames this reports the real
+and padded VL lengths, the latency of both and the max absolute difference of
+their action tensors.
+
+Without a checkpoint, a tiny model with random weights is used, whose sequence
+is only padded while the context fills up.
+
+    python scripts/bench_vl_padding.py ng.safetensors --cfg 2
+    python scripts/bench_vl_padding.py --ctx 4 --repeats 5
+"""
+import io
+import time
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+from nitrogen.inference_session import InferenceSession
+from bench_utils import tiny_session
+from bench_warm_start import synthetic_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VL padding benchmark")
+    parser.add_argument("ckpt", type=str, nargs="?", default=None, help="Checkpoint (default: tiny random model)")
+    parser.add_argument("--ctx", type=int, default=None, help="Context length (default: 1 with a checkpoint, 4 otherwise)")
+    parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the context, reset in between")
+    parser.add_argument("--device", type=str, default=None, help="Device to run inference on")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling noise")
+    args = parser.parse_args()
+
+    if args.ckpt is not None:
+        padded = InferenceSession.from_ckpt(args.ckpt, cfg_scale=args.cfg, context_length=args.ctx or 1, device=args.device)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            padded = tiny_session(context_length=args.ctx or 4, cfg_scale=args.cfg)
+    dropped = padded.fork()
+    dropped.drop_vl_padding = True
+    context_length = padded.max_buffer_size
+
+    stats = {}
+    frames = synthetic_frames(context_length * args.repeats)
+    for i, frame in enumerate(frames):
+        if i % context_length == 0:
+            padded.reset()
+            dropped.reset()
+        actions, latencies = [], []
+        for session in [padded, dropped]:
+            torch.manual_seed(args.seed + i)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                session.predict(frame)
+            latencies.append((time.perf_counter() - start) * 1000)
+            actions.append(session.action_buffer[-1]["action_tensor"].float().cpu().numpy())
+        s = stats.setdefault(len(padded.obs_buffer), {"padded_ms": [], "dropped_ms": [], "error": []})
+        s["padded_ms"].append(latencies[0])
+        s["dropped_ms"].append(latencies[1])
+        s["error"].append(float(np.abs(actions[0] - actions[1]).max()))
+
+    cond, _ = padded._tokenize(padded.obs_buffer.window())
+    max_length = cond["vl_token_ids"].shape[1]
+    tokens_per_frame = padded.tokenizer.num_visual_tokens_per_frame
+    num_extra = int(cond["vl_attn_mask"].sum()) - tokens_per_frame * len(padded.obs_buffer)
+    print(f"context {context_length}, cfg {args.cfg}, VL sequence padded to {max_length}")
+    print(f"{'frames':>6} {'VL tokens':>10} {'padded ms':>10} {'dropped ms':>11} {'max error':>10}")
+    for num_frames, s in sorted(stats.items()):
+        print(
+            f"{num_frames:>6} {num_extra + tokens_per_frame * num_frames:>10} {np.median(s['padded_ms']):>10.2f} "
+            f"{np.median(s['dropped_ms']):>11.2f} {np.max(s['error']):>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
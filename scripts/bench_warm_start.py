@@ -0,0 +1,138 @@
+"""
+Speed/quality trade-off of warm-started sampling against the full schedule.
+
+A stream of frames is fed to sessions sharing one model:
+- reference: cold start, full schedule.
+- cold: cold start, full schedule, other noise. Its deviation from the
+  reference is the spread between two samples of the model, the floor any
+  warm start should be compared to.
+- warm t0=...: starts from its previous chunk shifted by `--shift` actions and
+  noised to t0, and only integrates the remaining steps.
+
+For every prediction after the first one, it reports the number of DiT calls,
+the latency and the deviation of the chunk from the reference chunk for the
+same frame: mean absolute joystick error and fraction of matching buttons.
+
+Frames are read from `--video`, one every `--shift * action_downsample_ratio`
+frames, i.e. as often as a client executing `--shift` actions per prediction
+would capture them. Without it, a synthetic scene with a moving square is used.
+Without a checkpoint, a tiny model with random weights is used, which only
+exercises the code path and timings.
+
+    python scripts/bench_warm_start.py ng.safetensors --video gameplay.mp4 --t0 0.25 0.5 0.75
+    python scripts/bench_warm_start.py --frames 30
+"""
+import io
+import time
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+from nitrogen.inference_session import InferenceSession
+from bench_utils import tiny_session
+
+
+def synthetic_frames(num_frames, size=256):
+    """A square moving across a gradient, so that consecutive frames are correlated."""
+    background = np.broadcast_to(np.linspace(0, 255, size, dtype=np.uint8)[None, :, None], (size, size, 3))
+    for i in range(num_frames):
+        frame = background.copy()
+        x = int((i * 7) % (size - 32))
+        y = int(size / 2 + size / 4 * np.sin(i / 5)) - 16
+        frame[y:y + 32, x:x + 32] = [255, 64, 0]
+        yield frame
+
+
+def video_frames(path, num_frames, stride):
+    # OpenCV comes with the play dependencies, it is only needed to read videos
+    import cv2
+    capture = cv2.VideoCapture(path)
+    index = 0
+    while num_frames > 0:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if index % stride == 0:
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            num_frames -= 1
+        index += 1
+    capture.release()
+
+
+def deviation(pred, reference):
+    joysticks = np.concatenate([pred["j_left"], pred["j_right"]], axis=-1)
+    reference_joysticks = np.concatenate([reference["j_left"], reference["j_right"]], axis=-1)
+    return float(np.abs(joysticks - reference_joysticks).mean()), float((pred["buttons"] == reference["buttons"]).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm-started sampling benchmark")
+    parser.add_argument("ckpt", type=str, nargs="?", default=None, help="Checkpoint (default: tiny random model)")
+    parser.add_argument("--video", type=str, default=None, help="Video to read frames from (default: synthetic frames)")
+    parser.add_argument("--frames", type=int, default=50, help="Number of predictions")
+    parser.add_argument("--t0", type=float, nargs="+", default=[0.25, 0.5, 0.75], help="Warm start times to compare")
+    parser.add_argument("--shift", type=int, default=8, help="Actions executed between two predictions")
+    parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
+    parser.add_argument("--ctx", type=int, default=1, help="Context length")
+    parser.add_argument("--device", type=str, default=None, help="Device to run inference on")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling noise")
+    args = parser.parse_args()
+
+    if args.ckpt is not None:
+        reference = InferenceSession.from_ckpt(args.ckpt, cfg_scale=args.cfg, context_length=args.ctx, device=args.device)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            reference = tiny_session(context_length=args.ctx, cfg_scale=args.cfg)
+
+    sessions = {"reference": reference, "cold": reference.fork()}
+    for t0 in args.t0:
+        session = reference.fork()
+        session.warm_start_t0 = t0
+        session.warm_start_shift = args.shift
+        sessions[f"warm t0={t0}"] = session
+
+    # Count DiT calls through the shared model
+    dit_calls = [0]
+    dit_forward = reference.model.model.forward
+
+    def counted_forward(*f_args, **f_kwargs):
+        dit_calls[0] += 1
+        return dit_forward(*f_args, **f_kwargs)
+    reference.model.model.forward = counted_forward
+
+    if args.video is not None:
+        frames = video_frames(args.video, args.frames, args.shift * reference.action_downsample_ratio)
+    else:
+        frames = synthetic_frames(args.frames)
+
+    torch.manual_seed(args.seed)
+    stats = {name: {"calls": [], "latency_ms": [], "joystick_mae": [], "button_match": []} for name in sessions}
+    for i, frame in enumerate(frames):
+        preds = {}
+        for name, session in sessions.items():
+            dit_calls[0] = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                preds[name] = session.predict(frame)
+            if i > 0:
+                stats[name]["latency_ms"].append((time.perf_counter() - start) * 1000)
+                stats[name]["calls"].append(dit_calls[0])
+        if i > 0:
+            for name in sessions:
+                mae, match = deviation(preds[name], preds["reference"])
+                stats[name]["joystick_mae"].append(mae)
+                stats[name]["button_match"].append(match)
+
+    print(f"{len(stats['reference']['calls'])} predictions after the first, shift {args.shift}, cfg {args.cfg}")
+    print(f"{'':<16} {'DiT calls':>10} {'p50 ms':>10} {'joystick MAE':>14} {'buttons match':>14}")
+    for name, s in stats.items():
+        print(
+            f"{name:<16} {np.mean(s['calls']):>10.1f} {np.median(s['latency_ms']):>10.2f} "
+            f"{np.mean(s['joystick_mae']):>14.4f} {np.mean(s['button_match']):>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Rewrite a NitroGen checkpoint so that it can be loaded without network access,
+optionally in the fast-loading safetensors format.
+
+Older checkpoints only store the name of the vision encoder. This fetches its
+architecture config and image preprocessing parameters once and embeds them in
+the checkpoint config, so load_model can build the encoder and the image
+processor offline and load the weights from the checkpoint only.
+
+With `--format safetensors`, the weights are written to `<out>.safetensors` and
+the CkptConfig to a `<out>.json` sidecar. load_model memory-maps that format.
+
+    python scripts/convert_ckpt.py ng.pt ng_offline.pt
+    python scripts/convert_ckpt.py ng.pt ng.safetensors --format safetensors
+"""
+import json
+import argparse
+from pathlib import Path
+
+import torch
+from safetensors.torch import save_file
+
+from nitrogen.cfg import CkptConfig
+from nitrogen.flow_matching_transformer.nitrogen import get_vision_encoder_config
+from nitrogen.image_processor import get_image_processor_config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed configs needed for offline loading into a checkpoint")
+    parser.add_argument("ckpt", type=str, help="Path to the source checkpoint")
+    parser.add_argument("out", type=str, help="Path to the converted checkpoint")
+    parser.add_argument("--format", type=str, choices=["pt", "safetensors"], default="pt", help="Output format")
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.ckpt, map_location="cpu", weights_only=False)
+    ckpt_config = CkptConfig.model_validate(checkpoint["ckpt_config"])
+    model_cfg = ckpt_config.model_cfg
+
+    if model_cfg.vision_encoder_cfg is None:
+        print(f"Embedding vision encoder config for {model_cfg.vision_encoder_name}")
+        model_cfg.vision_encoder_cfg = get_vision_encoder_config(model_cfg.vision_encoder_name)
+    if ckpt_config.image_processor_cfg is None:
+        print(f"Embedding image processor config for {model_cfg.vision_encoder_name}")
+        ckpt_config.image_processor_cfg = get_image_processor_config(model_cfg.vision_encoder_name)
+
+    if args.format == "safetensors":
+        out = Path(args.out).with_suffix(".safetensors")
+        state_dict = {k: v.contiguous() for k, v in checkpoint["model"].items()}
+        save_file(state_dict, out, metadata={"format": "pt"})
+        with open(out.with_suffix(".json"), "w") as f:
+            json.dump(ckpt_config.model_dump(mode="json"), f, indent=2)
+        print(f"Saved weights to {out} and config to {out.with_suffix('.json')}")
+    else:
+        checkpoint["ckpt_config"] = ckpt_config.model_dump()
+        torch.save(checkpoint, args.out)
+        print(f"Saved converted checkpoint to {args.out}")
@@ -0,0 +1,56 @@
+"""
+Export a NitroGen checkpoint for inference only.
+
+The model is loaded, pruned with NitroGen.prune_for_inference (SigLIP pooling
+head, dropout layers, training time distribution) and its weights are cast to
+`--dtype`. They are written to `<out>.safetensors` next to a `<out>.json` config
+sidecar, with `inference_only` set so that load_model builds the pruned model,
+and with the vision encoder and image processor configs embedded as by
+convert_ckpt.py.
+
+In bf16, the checkpoint is half the size. load_model keeps the weights in bf16
+where inference runs under bf16 autocast (CUDA, CPUs with bf16 support), and
+upcasts them to fp32 otherwise, where the sampled actions then deviate slightly
+from the fp32 checkpoint. The fp32 export is exact.
+
+    python scripts/export_for_inference.py ng.pt ng_slim.safetensors --dtype bfloat16
+    python scripts/bench_load.py ng.safetensors ng_slim.safetensors
+"""
+import io
+import json
+import argparse
+import contextlib
+from pathlib import Path
+
+import torch
+from safetensors.torch import save_file
+
+from nitrogen.inference_session import load_model
+
+
+def num_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a slim inference-only checkpoint")
+    parser.add_argument("ckpt", type=str, help="Path to the source checkpoint (.pt or .safetensors)")
+    parser.add_argument("out", type=str, help="Path to the exported checkpoint")
+    parser.add_argument("--dtype", type=str, choices=["float32", "bfloat16", "float16"], default="float32", help="Storage dtype of the weights")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model, _, _, ckpt_config, _, _ = load_model(args.ckpt, device="cpu")
+    source_bytes = num_bytes(model.state_dict().values())
+
+    model.prune_for_inference()
+    model.to(getattr(torch, args.dtype))
+    ckpt_config.model_cfg.inference_only = True
+
+    out = Path(args.out).with_suffix(".safetensors")
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    save_file(state_dict, out, metadata={"format": "pt"})
+    with open(out.with_suffix(".json"), "w") as f:
+        json.dump(ckpt_config.model_dump(mode="json"), f, indent=2)
+    print(f"Weights: {source_bytes / 2**20:.1f} MB -> {num_bytes(state_dict.values()) / 2**20:.1f} MB ({args.dtype})")
+    print(f"Saved weights to {out} and config to {out.with_suffix('.json')}")
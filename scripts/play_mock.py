@@ -0,0 +1,171 @@
+"""
+Run the control loops of play.py against a mock env, on any OS.
+
+MockEnv stands in for GamepadEnv: each step lasts 1/fps seconds and returns a
+synthetic frame. In sync mode the mock game is paused while the agent waits,
+in pipelined mode it keeps running, as with `GamepadEnv(async_mode=True)`.
+Predictions come from a mock policy with a fixed latency, or from a running
+inference server with `--port`.
+
+For each mode this reports the wall-clock time, the achieved action rate, the
+time spent waiting for predictions and how old the frame behind each executed
+action was, i.e. of the latest chunk's frame. It also checks that every
+executed action sits at the index of its chunk matching the number of actions
+executed since the chunk's frame was captured.
+
+    python scripts/play_mock.py --latency-ms 60 --request-offset 8
+    python scripts/play_mock.py --latency-ms 60 --request-offset 2 --query-interval 4 --ensemble-decay 0.1
+    python scripts/play_mock.py --port 5555 --transport shm
+"""
+import time
+import argparse
+
+import numpy as np
+
+from nitrogen.control_loop import pred_to_env_actions, run_sync, run_pipelined, TemporalEnsemble
+from nitrogen.shared import BUTTON_ACTION_TOKENS
+
+
+class MockEnv:
+    """
+    Env whose steps last `1 / fps` seconds and whose frames encode the step count
+    and the game time. With `running`, the game clock follows the wall clock, so
+    it also advances while the agent waits; otherwise it only advances by steps.
+    """
+
+    def __init__(self, fps=60, image_size=(256, 256), running=False):
+        self.step_duration = 1 / fps
+        self.image_size = image_size
+        self.running = running
+        self.step_count = 0
+        self.start_time = time.perf_counter()
+        self.game_time = 0.0
+        self.last_step_end = None
+
+    def render(self):
+        frame = np.zeros((*self.image_size, 3), dtype=np.uint8)
+        frame.reshape(-1)[:16] = np.array([self.step_count, self.game_time]).view(np.uint8)
+        return frame
+
+    def step(self, action):
+        # Same pacing as GamepadEnv in async mode
+        start = time.perf_counter()
+        if self.last_step_end is not None and start - self.last_step_end < self.step_duration:
+            start = self.last_step_end
+        end = start + self.step_duration
+        time.sleep(max(0.0, end - time.perf_counter()))
+        self.last_step_end = end
+        self.step_count += 1
+        self.game_time = end - self.start_time if self.running else self.game_time + self.step_duration
+        return self.render(), 0.0, False, False, {}
+
+
+def frame_clock(frame) -> tuple[int, float]:
+    """Step count and game time encoded in a MockEnv frame."""
+    step_count, game_time = np.ascontiguousarray(frame).reshape(-1)[:16].copy().view(np.float64)
+    return int(step_count), float(game_time)
+
+
+class MockPolicy:
+    """Policy that answers after `latency_ms` with random actions."""
+
+    def __init__(self, latency_ms, action_horizon=16, seed=0):
+        self.latency_s = latency_ms / 1000
+        self.action_horizon = action_horizon
+        self.rng = np.random.default_rng(seed)
+
+    def predict(self, image):
+        time.sleep(self.latency_s)
+        return {
+            "j_left": self.rng.uniform(-1, 1, (self.action_horizon, 2)).astype(np.float32),
+            "j_right": self.rng.uniform(-1, 1, (self.action_horizon, 2)).astype(np.float32),
+            "buttons": self.rng.uniform(0, 1, (self.action_horizon, len(BUTTON_ACTION_TOKENS))).astype(np.float32),
+        }
+
+
+def run(mode, policy, args):
+    env = MockEnv(fps=args.fps, running=mode == "pipelined")
+    ages = []
+
+    def predict(obs):
+        pred = policy.predict(obs)
+        # Remember which frame the chunk was predicted from
+        return {**pred, "frame_clock": frame_clock(obs)}
+
+    def to_actions(pred):
+        return pred_to_env_actions(pred, no_menu=False)
+
+    chunk = {}
+
+    def on_step(obs, pred, index):
+        chunk["pred"], chunk["index"] = pred, index
+
+    def check_action(action, chunk_id, index):
+        frame_step, frame_time = chunk["pred"]["frame_clock"]
+        executed = env.step_count - frame_step
+        assert executed == (index + 1) * args.repeat, f"Action {index} of chunk {chunk_id} executed {executed} steps after its frame"
+        ages.append(env.game_time - frame_time)
+
+    obs, *_ = env.step(action=None)
+    start_time = time.perf_counter()
+    ensemble, blend_times = None, []
+    if args.ensemble_decay is not None:
+        ensemble = TemporalEnsemble(decay=args.ensemble_decay)
+        get = ensemble.get
+
+        def timed_get(step):
+            start = time.perf_counter()
+            action = get(step)
+            blend_times.append(time.perf_counter() - start)
+            return action
+        ensemble.get = timed_get
+
+    if mode == "pipelined":
+        stats = run_pipelined(
+            env, predict, obs, to_actions, args.request_offset,
+            repeat=args.repeat, num_chunks=args.chunks, on_step=on_step, on_action=check_action, ensemble=ensemble,
+        )
+    else:
+        stats = run_sync(
+            env, predict, obs, to_actions,
+            repeat=args.repeat, num_chunks=args.chunks, on_step=on_step, on_action=check_action,
+            query_interval=args.query_interval, ensemble=ensemble,
+        )
+    elapsed = time.perf_counter() - start_time
+
+    target_rate = args.fps / args.repeat
+    print(
+        f"{mode:>9}: {elapsed:.2f}s, {stats['num_actions']} actions at {stats['num_actions'] / elapsed:.1f}/s "
+        f"(target {target_rate:.1f}/s), waited {stats['wait_s']:.2f}s for {stats['num_chunks']} chunks, "
+        f"skipped {stats['skipped_actions']} actions, game time since frame mean {np.mean(ages) * 1000:.0f}ms "
+        f"max {np.max(ages) * 1000:.0f}ms"
+        + (f", blending {np.mean(blend_times) * 1e6:.1f}us per action" if len(blend_times) > 0 else "")
+    )
+    return stats, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync vs pipelined control loop on a mock env")
+    parser.add_argument("--fps", type=float, default=60, help="Env steps per second")
+    parser.add_argument("--repeat", type=int, default=1, help="Env steps per action (action_downsample_ratio)")
+    parser.add_argument("--chunks", type=int, default=20, help="Number of chunks to predict")
+    parser.add_argument("--request-offset", type=int, default=8, help="Actions of a chunk executed before the next request")
+    parser.add_argument("--query-interval", type=int, default=None, help="Actions executed per prediction in sync mode")
+    parser.add_argument("--ensemble-decay", type=float, default=None, help="Blend overlapping chunks with this decay")
+    parser.add_argument("--latency-ms", type=float, default=60, help="Latency of the mock policy")
+    parser.add_argument("--port", type=int, default=None, help="Use the inference server on this port instead of the mock policy")
+    parser.add_argument("--transport", type=str, choices=["tcp", "shm"], default="tcp", help="Transport to the inference server")
+    parser.add_argument("--ipc-path", type=str, default=None, help="Path of the server's ipc endpoint in shm mode")
+    args = parser.parse_args()
+
+    if args.port is not None:
+        from nitrogen.inference_client import ModelClient
+        policy = ModelClient(port=args.port, transport=args.transport, ipc_path=args.ipc_path)
+        args.repeat = policy.info()["action_downsample_ratio"]
+    else:
+        policy = MockPolicy(args.latency_ms)
+
+    for mode in ["sync", "pipelined"]:
+        if args.port is not None:
+            policy.reset()
+        run(mode, policy, args)
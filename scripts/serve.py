@@ -1,8 +1,9 @@
-import zmq
 import argparse
-import pickle
 
 from nitrogen.inference_session import InferenceSession
+from nitrogen.inference_server import InferenceServer
+from nitrogen.flow_matching_transformer.solvers import SolverConfig
+from nitrogen.protocol import default_ipc_path
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Model inference server")
@@ -11,54 +12,64 @@ if __name__ == "__main__":
     parser.add_argument("--old-layout", action="store_true", help="Use old layout")
     parser.add_argument("--cfg", type=float, default=1.0, help="CFG scale")
     parser.add_argument("--ctx", type=int, default=1, help="Context length")
+    parser.add_argument("--device", type=str, default=None, help="Device to run inference on (default: cuda if available, else cpu)")
+    parser.add_argument("--num-threads", type=int, default=None, help="Number of intra-op CPU threads")
+    cfg_batching = parser.add_mutually_exclusive_group()
+    cfg_batching.add_argument("--batched-cfg", action="store_true", help="Run the CFG branches as one batch (default on CUDA)")
+    cfg_batching.add_argument("--sequential-cfg", action="store_true", help="Run the CFG branches one after the other (default on CPU)")
+    parser.add_argument("--warm-start-t0", type=float, default=None, help="Start each prediction from the previous chunk noised to this time in [0, 1), skipping the earlier denoising steps")
+    parser.add_argument("--warm-start-shift", type=int, default=8, help="Number of actions the client executes between two predictions, to align the previous chunk")
+    parser.add_argument("--solver", type=str, choices=["euler", "heun", "midpoint"], default="euler", help="ODE solver of the action head")
+    parser.add_argument("--solver-steps", type=int, default=None, help="Number of solver steps (default: the model's num_inference_timesteps)")
+    parser.add_argument("--time-power", type=float, default=1.0, help="Solver time grid t_i = (i / N) ** power, 1 for uniform steps")
+    parser.add_argument("--drop-vl-padding", action="store_true", help="Drop the padding of the vision-language tokens instead of attending to it")
+    parser.add_argument("--quantize", type=str, choices=["int8"], default=None, help="Quantize the linear layers of the vision encoder, VL mixing and DiT (CPU only)")
+    parser.add_argument("--compile", action="store_true", help="Compile the vision encoder, VL mixing and DiT blocks with torch.compile")
+    parser.add_argument("--compile-cache-dir", type=str, default=None, help="Directory persisting the compiled graphs across restarts (default: the Inductor cache in the temp dir)")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of predict requests batched together")
+    parser.add_argument("--batch-timeout-ms", type=float, default=5.0, help="How long a batch waits for more requests after the first one")
+    parser.add_argument("--max-sessions", type=int, default=64, help="Maximum number of client sessions kept at once")
+    parser.add_argument("--active-window", type=float, default=1.0, help="Seconds since their last predict request during which batches wait for a client")
+    parser.add_argument("--session-timeout", type=float, default=600.0, help="Seconds after which an idle client session is evicted")
+    parser.add_argument("--ipc", action="store_true", help="Also listen on an ipc endpoint, for shared memory clients on this host")
+    parser.add_argument("--ipc-path", type=str, default=None, help="Path of the ipc endpoint (default: derived from the port)")
     args = parser.parse_args()
 
-    session = InferenceSession.from_ckpt(args.ckpt, old_layout=args.old_layout, cfg_scale=args.cfg, context_length=args.ctx)
+    session = InferenceSession.from_ckpt(
+        args.ckpt,
+        old_layout=args.old_layout,
+        cfg_scale=args.cfg,
+        context_length=args.ctx,
+        batched_cfg=True if args.batched_cfg else False if args.sequential_cfg else None,
+        device=args.device,
+        num_threads=args.num_threads,
+        warm_start_t0=args.warm_start_t0,
+        warm_start_shift=args.warm_start_shift,
+        solver=SolverConfig(method=args.solver, num_steps=args.solver_steps, time_power=args.time_power),
+        drop_vl_padding=args.drop_vl_padding,
+        quantization=args.quantize,
+        compile=args.compile,
+        compile_cache_dir=args.compile_cache_dir,
+    )
+    if args.compile:
+        print(f"Warming up the compiled model for batches of up to {args.max_batch_size} requests")
+        session.warm_up(args.max_batch_size)
 
-    # Setup ZeroMQ
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind(f"tcp://*:{args.port}")
-
-    # Create poller
-    poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
-
-    print(f"\n{'='*60}")
-    print(f"Server running on port {args.port}")
-    print(f"Waiting for requests...")
-    print(f"{'='*60}\n")
+    server = InferenceServer(
+        session,
+        port=args.port,
+        max_batch_size=args.max_batch_size,
+        batch_timeout_ms=args.batch_timeout_ms,
+        max_sessions=args.max_sessions,
+        session_timeout_s=args.session_timeout,
+        active_window_s=args.active_window,
+        ipc_path=(args.ipc_path or default_ipc_path(args.port)) if args.ipc else None,
+    )
 
     try:
-        while True:
-            # Poll with 100ms timeout to allow interrupt handling
-            events = dict(poller.poll(timeout=100))
-            if socket in events and events[socket] == zmq.POLLIN:
-                # Receive request only when data is available
-                request = socket.recv()
-                request = pickle.loads(request)
-                if request["type"] == "reset":
-                    session.reset()
-                    response = {"status": "ok"}
-                    print("Session reset")
-                elif request["type"] == "info":
-                    info = session.info()
-                    response = {"status": "ok", "info": info}
-                    print("Sent session info")
-                elif request["type"] == "predict":
-                    raw_image = request["image"]
-                    result = session.predict(raw_image)
-                    response = {
-                        "status": "ok",
-                        "pred": result
-                    }
-                else:
-                    response = {"status": "error", "message": f"Unknown request type: {request['type']}"}
-                # Send response
-                socket.send(pickle.dumps(response))
+        server.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down server...")
         exit(0)
     finally:
-        socket.close()
-        context.term()
+        server.close()